@@ -0,0 +1,447 @@
+import hashlib
+from array import array
+from heapq import heapify, heappop, heappush
+from math import ceil, e, exp, fsum, log
+from statistics import median
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Aggregator:
+    """Base per-URL aggregator.
+
+    Keeps the totals every report needs (lines, parsing errors, overall request time).
+    Subclasses store per-URL data and must be mergeable, so partial results
+    built by different workers can be combined into one report. By default merge
+    takes over per-URL data of the merged aggregator, which must not be used afterwards;
+    with adopt=False that data is copied instead and the merged aggregator is left intact.
+    """
+
+    def __init__(self):
+        self.total_lines = 0
+        self.errors = 0
+        self.total_time = 0
+
+    def add(self, url: str, request_time: float):
+        self.total_lines += 1
+        self.total_time += request_time
+
+    def add_error(self):
+        self.total_lines += 1
+        self.errors += 1
+
+    def merge(self, other: 'Aggregator', adopt: bool = True) -> 'Aggregator':
+        self.total_lines += other.total_lines
+        self.errors += other.errors
+        self.total_time += other.total_time
+        return self
+
+    @property
+    def errors_ratio(self) -> float:
+        return round(self.errors / self.total_lines, 2)
+
+    @property
+    def urls_count(self) -> int:
+        """Number of distinct URLs currently kept."""
+        return len(self.urls_info)
+
+    def rows(self) -> list:
+        """Per-URL dicts with url, count, time_sum, time_max, time_avg and time_med keys."""
+        raise NotImplementedError
+
+    def report_table(self, report_size: int) -> list:
+        urls_table_data = []
+        for row in sorted(self.rows(), key=lambda item: item['time_sum'], reverse=True):
+            if len(urls_table_data) == report_size:
+                break
+            row['count_perc'] = round(row['count'] / self.total_lines * 100)
+            row['time_perc'] = round(row['time_sum'] / self.total_time * 100)
+            row['time_sum'] = round(row['time_sum'], 3)
+            urls_table_data.append(row)
+        return urls_table_data
+
+
+class ExactAggregator(Aggregator):
+    """Keeps every request time per URL, so all statistics are exact."""
+
+    def __init__(self):
+        super().__init__()
+        self.urls_info = {}
+
+    def add(self, url: str, request_time: float):
+        super().add(url, request_time)
+        info = self.urls_info.get(url)
+        if info is None:
+            info = self.urls_info[url] = {'count': 0, 'time_sum': 0, 'timings': []}
+        info['count'] += 1
+        info['time_sum'] += request_time
+        info['timings'].append(request_time)
+
+    def merge(self, other: 'ExactAggregator', adopt: bool = True) -> 'ExactAggregator':
+        super().merge(other)
+        for url, other_info in other.urls_info.items():
+            info = self.urls_info.get(url)
+            if info is None:
+                self.urls_info[url] = other_info if adopt else dict(other_info, timings=list(other_info['timings']))
+            else:
+                info['count'] += other_info['count']
+                info['time_sum'] += other_info['time_sum']
+                info['timings'].extend(other_info['timings'])
+        return self
+
+    def rows(self) -> list:
+        return [
+            {
+                'url': url,
+                'count': info['count'],
+                'time_sum': info['time_sum'],
+                'time_max': max(info['timings']),
+                # statistics.mean sums exact fractions, several times slower than the correctly rounded fsum
+                'time_avg': round(fsum(info['timings']) / info['count'], 3),
+                'time_med': round(median(info['timings']), 3),
+            }
+            for url, info in self.urls_info.items()
+        ]
+
+
+class QuantileSketch:
+    """Log-bucketed quantile sketch (DDSketch).
+
+    Values are counted in buckets whose bounds grow geometrically by GAMMA, so any
+    quantile is returned with a relative error of at most RELATIVE_ACCURACY (1 %):
+    for a true quantile value v the estimate lies within [0.99 * v, 1.01 * v].
+    At most MAX_BINS buckets are kept; when more are needed the lowest buckets are
+    collapsed, which only affects quantiles that fall into them.
+    Sketches with the same parameters are merged by adding bucket counts.
+    """
+    RELATIVE_ACCURACY = 0.01
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = log(GAMMA)
+    MIN_VALUE = 1e-9
+    MAX_BINS = 2048
+
+    __slots__ = ('bins', 'zero_count', 'count')
+
+    def __init__(self):
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float):
+        self.count += 1
+        if value < self.MIN_VALUE:
+            self.zero_count += 1
+            return
+        key = ceil(log(value) / self.LOG_GAMMA)
+        self.bins[key] = self.bins.get(key, 0) + 1
+        if len(self.bins) > self.MAX_BINS:
+            self._collapse()
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, bin_count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + bin_count
+        if len(self.bins) > self.MAX_BINS:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        overflow = keys[:len(keys) - self.MAX_BINS + 1]
+        self.bins[overflow[-1]] += sum(self.bins.pop(key) for key in overflow[:-1])
+
+    def quantile(self, q: float) -> float:
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.GAMMA ** key / (self.GAMMA + 1)
+        return 0
+
+
+class SketchAggregator(Aggregator):
+    """Keeps a fixed-size quantile sketch per URL instead of every request time.
+
+    Memory grows with the number of URLs, not requests. Count, sum, max and average
+    stay exact; median, p95 and p99 have the QuantileSketch error bound.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.urls_info = {}
+
+    def add(self, url: str, request_time: float):
+        super().add(url, request_time)
+        info = self.urls_info.get(url)
+        if info is None:
+            info = self.urls_info[url] = [0, 0, 0, QuantileSketch()]
+        info[0] += 1
+        info[1] += request_time
+        if request_time > info[2]:
+            info[2] = request_time
+        info[3].add(request_time)
+
+    def merge(self, other: 'SketchAggregator', adopt: bool = True) -> 'SketchAggregator':
+        super().merge(other)
+        for url, other_info in other.urls_info.items():
+            info = self.urls_info.get(url)
+            if info is None:
+                self.urls_info[url] = other_info if adopt else [*other_info[:3], QuantileSketch().merge(other_info[3])]
+            else:
+                info[0] += other_info[0]
+                info[1] += other_info[1]
+                info[2] = max(info[2], other_info[2])
+                info[3].merge(other_info[3])
+        return self
+
+    def rows(self) -> list:
+        return [
+            {
+                'url': url,
+                'count': count,
+                'time_sum': time_sum,
+                'time_max': time_max,
+                'time_avg': round(time_sum / count, 3),
+                'time_med': round(sketch.quantile(0.5), 3),
+                'time_p95': round(sketch.quantile(0.95), 3),
+                'time_p99': round(sketch.quantile(0.99), 3),
+            }
+            for url, (count, time_sum, time_max, sketch) in self.urls_info.items()
+        ]
+
+
+class NumpyAggregator(Aggregator):
+    """Columnar engine: interns URLs to integer ids and appends (url_id, request_time)
+    to compact typed buffers; statistics for all URLs are computed at once with NumPy.
+    """
+    PERCENTILES = {'time_p95': 0.95, 'time_p99': 0.99}
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('numpy engine requires numpy to be installed')
+        super().__init__()
+        self.url_ids = {}
+        self.urls = []
+        self.ids = array('I')
+        self.timings = array('d')
+
+    def _url_id(self, url: str) -> int:
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+        return url_id
+
+    def add(self, url: str, request_time: float):
+        super().add(url, request_time)
+        self.ids.append(self._url_id(url))
+        self.timings.append(request_time)
+
+    def merge(self, other: 'NumpyAggregator', adopt: bool = True) -> 'NumpyAggregator':
+        super().merge(other)
+        if other.urls:
+            id_map = np.array([self._url_id(url) for url in other.urls], dtype=np.uintc)
+            self.ids.frombytes(id_map[np.frombuffer(other.ids, dtype=np.uintc)].tobytes())
+            self.timings.extend(other.timings)
+        return self
+
+    @property
+    def urls_count(self) -> int:
+        return len(self.urls)
+
+    def rows(self) -> list:
+        if not self.ids:
+            return []
+        ids = np.frombuffer(self.ids, dtype=np.uintc)
+        timings = np.frombuffer(self.timings, dtype=np.float64)
+        order = np.lexsort((timings, ids))
+        ids, timings = ids[order], timings[order]
+        del order
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        counts = np.diff(np.append(starts, len(ids)))
+        columns = {
+            'count': counts,
+            'time_sum': np.add.reduceat(timings, starts),
+            'time_max': timings[starts + counts - 1],
+            'time_med': (timings[starts + (counts - 1) // 2] + timings[starts + counts // 2]) / 2,
+        }
+        columns['time_avg'] = columns['time_sum'] / counts
+        for name, q in self.PERCENTILES.items():
+            columns[name] = timings[starts + (q * (counts - 1)).astype(np.int64)]
+        columns = {name: column.tolist() for name, column in columns.items()}
+        rounded = ['time_avg', 'time_med', *self.PERCENTILES]
+        for name in rounded:
+            columns[name] = [round(value, 3) for value in columns[name]]
+        return [
+            dict({name: column[i] for name, column in columns.items()}, url=self.urls[url_id])
+            for i, url_id in enumerate(ids[starts].tolist())
+        ]
+
+
+class CountMinSketch:
+    """Count-Min sketch: `depth` rows of `width` counters indexed by independent hashes.
+
+    An estimate never underestimates the true count and exceeds it by at most
+    e / width * total with probability 1 - exp(-depth).
+    Row indexes are 4-byte slices of one blake2b digest of the key: independent across rows
+    (unlike seeded crc32, which is linear) and stable, so sketches built in different processes merge.
+    """
+
+    def __init__(self, width: int = 2 ** 16, depth: int = 4):
+        if not 1 <= depth <= 16:
+            raise ValueError('Depth must be within 1..16, a blake2b digest has 16 indexes at most')
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.rows = [array('L', bytes(array('L').itemsize * width)) for _ in range(depth)]
+
+    @property
+    def epsilon(self) -> float:
+        return e / self.width
+
+    @property
+    def confidence(self) -> float:
+        return 1 - exp(-self.depth)
+
+    def _indexes(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[offset:offset + 4], 'little') % self.width
+                for offset in range(0, 4 * self.depth, 4)]
+
+    def add(self, key: bytes, count: int = 1):
+        self.total += count
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+
+    def estimate(self, key: bytes) -> int:
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    def merge(self, other: 'CountMinSketch') -> 'CountMinSketch':
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Only sketches of the same size can be merged')
+        self.total += other.total
+        for row, other_row in zip(self.rows, other.rows):
+            for index, count in enumerate(other_row):
+                if count:
+                    row[index] += count
+        return self
+
+
+class TopKAggregator(Aggregator):
+    """Approximate heavy hitters by time_sum for unbounded URL cardinality.
+
+    At most `capacity` URLs are tracked (weighted Space-Saving keyed on time_sum): an untracked
+    URL replaces the tracked one with the smallest time_sum and inherits that value as its error.
+    For every reported URL `time_sum - time_sum_err <= true time_sum <= time_sum`, and every URL
+    whose true time_sum exceeds total_time / capacity is guaranteed to be reported.
+    Counts come from a Count-Min sketch, so `count - count_err <= true count <= count`, and
+    count_err <= e / width * lines with probability 1 - exp(-depth).
+    time_max, time_med, time_p95 and time_p99 only cover requests seen while the URL was tracked.
+    """
+
+    def __init__(self, capacity: int = 10000, width: int = 2 ** 16, depth: int = 4):
+        super().__init__()
+        self.capacity = capacity
+        self.counts = CountMinSketch(width, depth)
+        # url -> [time_sum, time_sum_err, tracked_count, time_max, sketch]
+        self.urls_info = {}
+        # one (time_sum, url) item per tracked URL; time_sum there may lag behind, see _evict_min()
+        self.heap = []
+
+    def _evict_min(self) -> float:
+        while True:
+            time_sum, url = heappop(self.heap)
+            current_time_sum = self.urls_info[url][0]
+            if current_time_sum == time_sum:
+                del self.urls_info[url]
+                return time_sum
+            heappush(self.heap, (current_time_sum, url))
+
+    def add(self, url: str, request_time: float):
+        super().add(url, request_time)
+        self.counts.add(url.encode())
+        info = self.urls_info.get(url)
+        if info is None:
+            min_time_sum = self._evict_min() if len(self.urls_info) >= self.capacity else 0
+            info = self.urls_info[url] = [min_time_sum, min_time_sum, 0, 0, QuantileSketch()]
+            heappush(self.heap, (min_time_sum, url))
+        info[0] += request_time
+        info[2] += 1
+        if request_time > info[3]:
+            info[3] = request_time
+        info[4].add(request_time)
+
+    @property
+    def min_time_sum(self) -> float:
+        """Upper bound of the time_sum of any untracked URL."""
+        if len(self.urls_info) < self.capacity:
+            return 0
+        return min(info[0] for info in self.urls_info.values())
+
+    def merge(self, other: 'TopKAggregator', adopt: bool = True) -> 'TopKAggregator':
+        super().merge(other)
+        self.counts.merge(other.counts)
+        self_min, other_min = self.min_time_sum, other.min_time_sum
+        for url, info in self.urls_info.items():
+            if url not in other.urls_info:
+                info[0] += other_min
+                info[1] += other_min
+        for url, other_info in other.urls_info.items():
+            info = self.urls_info.get(url)
+            if info is None:
+                if not adopt:
+                    other_info = [*other_info[:4], QuantileSketch().merge(other_info[4])]
+                other_info[0] += self_min
+                other_info[1] += self_min
+                self.urls_info[url] = other_info
+            else:
+                info[0] += other_info[0]
+                info[1] += other_info[1]
+                info[2] += other_info[2]
+                info[3] = max(info[3], other_info[3])
+                info[4].merge(other_info[4])
+        if len(self.urls_info) > self.capacity:
+            kept = sorted(self.urls_info.items(), key=lambda item: item[1][0], reverse=True)[:self.capacity]
+            self.urls_info = dict(kept)
+        self.heap = [(info[0], url) for url, info in self.urls_info.items()]
+        heapify(self.heap)
+        return self
+
+    def rows(self) -> list:
+        rows = []
+        for url, (time_sum, time_sum_err, tracked_count, time_max, sketch) in self.urls_info.items():
+            count = self.counts.estimate(url.encode())
+            rows.append({
+                'url': url,
+                'count': count,
+                'count_err': count - tracked_count,
+                'time_sum': time_sum,
+                'time_sum_err': round(time_sum_err, 3),
+                'time_max': time_max,
+                'time_avg': round(time_sum / count, 3),
+                'time_med': round(sketch.quantile(0.5), 3),
+                'time_p95': round(sketch.quantile(0.95), 3),
+                'time_p99': round(sketch.quantile(0.99), 3),
+            })
+        return rows
+
+
+ENGINES = {
+    'exact': ExactAggregator,
+    'sketch': SketchAggregator,
+    'numpy': NumpyAggregator,
+    'topk': TopKAggregator,
+}
+# engines whose state does not grow with the number of requests, so it can be checkpointed
+COMPACT_ENGINES = ('sketch', 'topk')
+
+
+def create_aggregator(engine: str, engine_options: dict = None) -> Aggregator:
+    return ENGINES[engine](**(engine_options or {}))
@@ -0,0 +1,188 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from aggregators import ENGINES, create_aggregator
+from generator import LATENCIES, generate_log
+from log_analyzer import process_logfile, read_lines, save_report
+from parsers import PARSERS, create_parser
+
+REPORT_SIZE = 1000
+# a stage is a regression if its throughput drops by more than this share against the baseline
+REGRESSION_TOLERANCE = 0.1
+
+
+def read_stage(log_path: str) -> int:
+    return sum(1 for _ in read_lines(log_path))
+
+
+def parse_stage(lines: list, parser: str) -> int:
+    parse_line = create_parser(parser)
+    for line in lines:
+        parse_line(line)
+    return len(lines)
+
+
+def aggregate_stage(parsed_lines: list, engine: str) -> int:
+    aggregator = create_aggregator(engine)
+    for parsed in parsed_lines:
+        aggregator.add(*parsed)
+    aggregator.report_table(REPORT_SIZE)
+    return len(parsed_lines)
+
+
+def save_report_stage(stats: list, reports_dir: str) -> int:
+    save_report(stats, reports_dir, datetime(2017, 6, 30))
+    return len(stats)
+
+
+def process_logfile_stage(log_path: str, lines_count: int) -> int:
+    process_logfile(log_path, REPORT_SIZE, 1.0)
+    return lines_count
+
+
+def prepare_stage(stage: str, log_path: str, reports_dir: str) -> tuple:
+    """Returns the stage function and its arguments; inputs are built before timing starts."""
+    name, _, variant = stage.partition(':')
+    if name == 'read_lines':
+        return read_stage, (f'{log_path}.gz' if variant == 'gz' else log_path,)
+    lines = list(read_lines(log_path))
+    if name == 'process_logfile':
+        return process_logfile_stage, (log_path, len(lines))
+    if name == 'parse':
+        return parse_stage, (lines, variant)
+    parse_line = create_parser()
+    parsed_lines = [parsed for parsed in map(parse_line, lines) if parsed]
+    del lines
+    if name == 'aggregate':
+        return aggregate_stage, (parsed_lines, variant)
+    if name == 'save_report':
+        aggregator = create_aggregator('exact')
+        for parsed in parsed_lines:
+            aggregator.add(*parsed)
+        return save_report_stage, (aggregator.report_table(REPORT_SIZE), reports_dir)
+    raise ValueError(f'Unknown stage {stage}')
+
+
+def run_stage(stage: str, log_path: str, reports_dir: str) -> dict:
+    """Runs one stage in the current (fresh) process and measures it.
+
+    Peak RSS is the process high-water mark, so it includes the stage inputs;
+    rss_growth_kb is how much the stage itself raised it.
+    """
+    stage_function, args = prepare_stage(stage, log_path, reports_dir)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started_at = time.perf_counter()
+    items = stage_function(*args)
+    seconds = time.perf_counter() - started_at
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'seconds': round(seconds, 4),
+        'items': items,
+        'items_per_sec': round(items / seconds) if seconds else None,
+        'peak_rss_kb': peak_rss,
+        'rss_growth_kb': peak_rss - rss_before,
+    }
+
+
+def get_stages() -> list:
+    return [
+        'read_lines:log',
+        'read_lines:gz',
+        *(f'parse:{parser}' for parser in PARSERS),
+        *(f'aggregate:{engine}' for engine in ENGINES),
+        'save_report',
+        'process_logfile',
+    ]
+
+
+def run_benchmark(lines_count: int, urls_count: int, latency: str, errors_ratio: float, seed: int = 0,
+                  stages: list = None) -> dict:
+    """Generates a log and runs every stage in its own process, so peak RSS is measured per stage."""
+    stages = stages or get_stages()
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'lines': lines_count,
+            'urls': urls_count,
+            'latency': latency,
+            'errors_ratio': errors_ratio,
+            'seed': seed,
+        },
+        'stages': {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        log_path = generate_log(os.path.join(work_dir, 'nginx-access-ui.log-20170630'), lines_count, urls_count,
+                                latency, errors_ratio, seed)
+        generate_log(f'{log_path}.gz', lines_count, urls_count, latency, errors_ratio, seed)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            with open('report.html', 'w', encoding='utf-8') as template_file:
+                template_file.write('<script>var table = $table_json;</script>')
+            for stage in stages:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    try:
+                        results['stages'][stage] = executor.submit(run_stage, stage, log_path, work_dir).result()
+                    except RuntimeError as e:
+                        results['stages'][stage] = {'skipped': str(e)}
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list:
+    regressions = []
+    for stage, result in results['stages'].items():
+        baseline_result = baseline['stages'].get(stage, {})
+        if result.get('items_per_sec') and baseline_result.get('items_per_sec'):
+            ratio = result['items_per_sec'] / baseline_result['items_per_sec']
+            if ratio < 1 - tolerance:
+                regressions.append(f'{stage}: {result["items_per_sec"]}/sec against '
+                                   f'{baseline_result["items_per_sec"]}/sec ({ratio - 1:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser('LogAnalyzerBenchmark')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=1000)
+    parser.add_argument('--latency', choices=sorted(LATENCIES), default='lognormal')
+    parser.add_argument('--errors-ratio', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=get_stages(), help='run only these stages')
+    parser.add_argument('--output', help='results file, benchmarks/benchmark-<date>.json by default')
+    parser.add_argument('--baseline', help='previous results file to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.lines, args.urls, args.latency, args.errors_ratio, args.seed, args.stages)
+    output_path = args.output or f'benchmarks/benchmark-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+    for stage, result in results['stages'].items():
+        if 'skipped' in result:
+            print(f'{stage:<24} skipped: {result["skipped"]}')
+        else:
+            print(f'{stage:<24} {result["seconds"]:>9.3f} s {result["items_per_sec"]:>12}/sec '
+                  f'{result["peak_rss_kb"] // 1024:>7} MB peak RSS (+{result["rss_growth_kb"] // 1024} MB)')
+    print(f'Results saved to {output_path}')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file))
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import json
+import os
+from datetime import datetime
+
+from aggregators import Aggregator, create_aggregator
+from readers import BLOCK_SIZE
+
+WINDOWS = (5, 15, 60)
+BUCKET_SECONDS = 60
+
+
+class LogTail:
+    """Follows a growing log like `tail -F`, returning only complete lines.
+
+    If the path starts pointing to another file (the log was rotated by renaming), the old
+    file is read to its end first and the new one is followed from its start. If the file
+    shrinks (rotated with copytruncate), it is reread from the start.
+    """
+
+    def __init__(self, log_path: str, from_end: bool = True):
+        self.log_path = log_path
+        self.file = None
+        self.file_id = None
+        self.tail = b''
+        self._open(from_end)
+
+    def _open(self, from_end: bool = False):
+        try:
+            self.file = open(self.log_path, 'rb')
+        except FileNotFoundError:
+            self.file = None
+            return
+        stat = os.fstat(self.file.fileno())
+        self.file_id = (stat.st_dev, stat.st_ino)
+        self.tail = b''
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_available(self) -> bytes:
+        while True:
+            block = self.file.read(BLOCK_SIZE)
+            if not block:
+                return
+            block = self.tail + block
+            cut = block.rfind(b'\n') + 1
+            self.tail = block[cut:]
+            if cut:
+                yield from block[:cut - 1].split(b'\n')
+
+    def lines(self) -> bytes:
+        """Yields lines appended since the previous call."""
+        if self.file is None:
+            self._open()
+            if self.file is None:
+                return
+        yield from self._read_available()
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            # rotated, the new file is not created yet
+            return
+        if (stat.st_dev, stat.st_ino) != self.file_id:
+            if self.tail:
+                yield self.tail
+            self.close()
+            self._open()
+            if self.file is not None:
+                yield from self._read_available()
+        elif stat.st_size < self.file.tell():
+            self.file.seek(0)
+            self.tail = b''
+            yield from self._read_available()
+
+
+class SlidingWindows:
+    """Per-URL aggregates of the last minutes kept in a ring buffer of one-minute buckets.
+
+    Lines are added to the bucket of the current minute, so an update is O(1) per line;
+    a bucket is reused once it falls out of the longest window, so memory is bounded by
+    the window size, not by the log length. A window of N minutes covers the current
+    (partial) minute and N - 1 previous ones.
+    """
+
+    def __init__(self, windows: tuple = WINDOWS, engine: str = 'exact', engine_options: dict = None):
+        self.windows = sorted(windows)
+        self.engine = engine
+        self.engine_options = engine_options
+        # (bucket number, aggregator) per slot
+        self.buckets = [None] * self.windows[-1]
+
+    def bucket(self, now: float) -> Aggregator:
+        """Returns the aggregator lines arriving at `now` go to."""
+        number = int(now // BUCKET_SECONDS)
+        slot = number % len(self.buckets)
+        bucket = self.buckets[slot]
+        if bucket is None or bucket[0] != number:
+            bucket = self.buckets[slot] = (number, create_aggregator(self.engine, self.engine_options))
+        return bucket[1]
+
+    def snapshot(self, now: float, report_size: int) -> dict:
+        """Report tables of every window, built by merging buckets from the newest one back."""
+        number = int(now // BUCKET_SECONDS)
+        aggregator = create_aggregator(self.engine, self.engine_options)
+        windows = {}
+        for age in range(self.windows[-1]):
+            bucket = self.buckets[(number - age) % len(self.buckets)]
+            if bucket is not None and bucket[0] == number - age:
+                # the bucket keeps receiving lines, so its per-URL data is copied, not taken over
+                aggregator.merge(bucket[1], adopt=False)
+            if age + 1 in self.windows:
+                windows[f'{age + 1}m'] = {
+                    'lines': aggregator.total_lines,
+                    'errors': aggregator.errors,
+                    'table': aggregator.report_table(report_size) if aggregator.total_time else [],
+                }
+        return {'updated': datetime.fromtimestamp(now).isoformat(timespec='seconds'), 'windows': windows}
+
+
+def save_snapshot(path: str, snapshot: dict):
+    """Replaces the snapshot atomically, so readers never see a partially written file."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(tmp_path, path)
@@ -0,0 +1,84 @@
+import argparse
+import gzip
+import random
+from datetime import datetime, timedelta
+
+USER_AGENTS = [
+    'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115 Safari/537.36',
+    'python-requests/2.13.0',
+    '-',
+]
+URL_PATTERNS = [
+    '/api/v2/banner/{id}',
+    '/api/v2/group/{id}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{id}',
+    '/api/v2/slot/{id}/groups',
+    '/export/appinstall_raw/2017-06-{id}/',
+]
+LATENCIES = {
+    'exponential': lambda rnd: rnd.expovariate(5),
+    'lognormal': lambda rnd: rnd.lognormvariate(-2, 1),
+    'pareto': lambda rnd: 0.01 * rnd.paretovariate(1.5),
+}
+LOG_LINE = (
+    '{ip} -  - [{time}] "{method} {url} HTTP/1.1" {status} {size} "-" "{user_agent}" "-" '
+    '"{request_id}" "{rb_user}" {request_time:.3f}\n'
+)
+BROKEN_LOG_LINE = '{ip} -  - [{time}] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n'
+
+
+def generate_lines(lines_count: int, urls_count: int = 1000, latency: str = 'lognormal', errors_ratio: float = 0.0,
+                   seed: int = 0, date: datetime = datetime(2017, 6, 30)) -> str:
+    """Yields nginx `ui` format log lines; the same arguments always give the same lines.
+
+    URL popularity is Zipf-like (a few hot URLs, a long tail), request times follow `latency`.
+    """
+    rnd = random.Random(seed)
+    latency_of = LATENCIES[latency]
+    step = timedelta(days=1) / max(lines_count, 1)
+    for number in range(lines_count):
+        time = (date + step * number).strftime('%d/%b/%Y:%H:%M:%S +0300')
+        ip = f'1.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}'
+        if rnd.random() < errors_ratio:
+            yield BROKEN_LOG_LINE.format(ip=ip, time=time)
+            continue
+        url_number = int(rnd.paretovariate(1)) % urls_count
+        url = URL_PATTERNS[url_number % len(URL_PATTERNS)].format(id=url_number)
+        yield LOG_LINE.format(
+            ip=ip,
+            time=time,
+            method='GET' if rnd.random() < 0.9 else 'POST',
+            url=url,
+            status=200 if rnd.random() < 0.95 else 404,
+            size=rnd.randint(0, 100000),
+            user_agent=rnd.choice(USER_AGENTS),
+            request_id=f'{1498697422 + number}-{rnd.getrandbits(32)}-4708-{rnd.randint(0, 9999999)}',
+            rb_user=f'{rnd.getrandbits(36):09x}',
+            request_time=latency_of(rnd),
+        )
+
+
+def generate_log(log_path: str, lines_count: int, urls_count: int = 1000, latency: str = 'lognormal',
+                 errors_ratio: float = 0.0, seed: int = 0) -> str:
+    """Writes a synthetic log, gzip-compressed if `log_path` ends with .gz."""
+    log_writer = gzip.open if log_path.endswith('.gz') else open
+    with log_writer(log_path, 'wt', encoding='utf-8') as log_file:
+        log_file.writelines(generate_lines(lines_count, urls_count, latency, errors_ratio, seed))
+    return log_path
+
+
+def main():
+    parser = argparse.ArgumentParser('LogGenerator')
+    parser.add_argument('log_path', help='output file, .gz to compress')
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--urls', type=int, default=1000, help='number of distinct URLs')
+    parser.add_argument('--latency', choices=sorted(LATENCIES), default='lognormal')
+    parser.add_argument('--errors-ratio', type=float, default=0.0, help='share of lines in a wrong format')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    generate_log(args.log_path, args.lines, args.urls, args.latency, args.errors_ratio, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import json
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class RunStats:
+    """Per-stage timings and counters of one run, logged as a single structured record.
+
+    Stats gathered in worker processes are merged into the parent's, so stage times
+    are summed over all workers (CPU time spent per stage rather than wall time).
+    Reading, parsing and aggregation are timed as one 'scan' stage unless `detailed`,
+    since splitting them takes extra work on the hot loop.
+    """
+
+    def __init__(self, detailed: bool = False):
+        self.detailed = detailed
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started_at
+
+    def add_time(self, name: str, seconds: float):
+        self.stages[name] += seconds
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def merge(self, other: 'RunStats') -> 'RunStats':
+        for name, seconds in other.stages.items():
+            self.stages[name] += seconds
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        return self
+
+    def record(self) -> dict:
+        record = {
+            'stages': {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            'counters': dict(self.counters),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'workers_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+        # wall time of the whole run if known, worker stage times overlap
+        seconds = self.stages.get('total') or sum(
+            self.stages.get(name, 0) for name in ('scan', 'read', 'parse', 'aggregate')
+        )
+        if self.counters.get('lines') and seconds:
+            record['lines_per_sec'] = round(self.counters['lines'] / seconds)
+        return record
+
+    def __str__(self):
+        return f'Run stats: {json.dumps(self.record())}'
@@ -1,129 +1,602 @@
 import os
-import gzip
+import json
 import re
+import time
 import argparse
-from statistics import mean, median
+import cProfile
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 from string import Template
 from datetime import datetime
 from configparser import ConfigParser
 
+from aggregators import COMPACT_ENGINES, ENGINES, Aggregator, create_aggregator
+from follow import LogTail, SlidingWindows, save_snapshot
+from instrumentation import RunStats
 from logger import logger
+from parsers import DEFAULT_LOG_FORMAT, PARSERS, create_parser
+from readers import MappedLog, read_gzip_lines, read_mapped_lines
+from sampling import LogSample
+from state import load_state, save_state
 
 
 DEFAULT_CONFIG = {
         "REPORT_SIZE": 1000,
         "REPORT_DIR": "./reports",
         "LOG_DIR": "./log",
-        "ERRORS_THRESHOLD": 0.2
+        "ERRORS_THRESHOLD": 0.2,
+        "WORKERS": 1,
+        "ENGINE": "exact",
+        "PARSER": "regex",
+        "INCREMENTAL": False,
+        "CHECKPOINT_DIR": "./checkpoints",
+        "BATCH": False,
+        "ROLLUP": None,
+        "AGGREGATES_DIR": "./aggregates",
+        "TOPK_CAPACITY": 10000,
+        "URL_TEMPLATES": [],
+        "SAMPLE": False,
+        "APPROXIMATE": False,
+        "PROFILE": None,
+        "FOLLOW": False,
+        "FOLLOW_INTERVAL": 10,
+        "REPORT_FORMAT": "inline",
+        "LOG_FORMAT": None,
+        "LOG_FORMATS": {"ui": DEFAULT_LOG_FORMAT},
     }
+PROFILE_PATH = 'log_analyzer.prof'
+# lines per block when reading, parsing and aggregation are timed separately
+STATS_BLOCK_LINES = 4096
+REPORT_FORMATS = ('inline', 'paged')
+PAGED_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'report_paged.html')
 
 
-def get_last_logfile_info(log_dir: str) -> tuple:
-    log_files = []
-    for log_name in os.listdir(log_dir):
+def get_logfiles_info(log_dir: str) -> list:
+    """Returns (path, date) of every log in `log_dir`, oldest first."""
+    logs_info = []
+    for log_name in sorted(os.listdir(log_dir)):
         ext = log_name.split('.')[-1]
-        if ext == 'gz' or ext.startswith('log'):
-            log_files.append(log_name)
-    if log_files:
-        last_log_path = f'{log_dir}/{sorted(log_files)[-1]}'
-        date = datetime.strptime(re.findall(r'\d{8}', last_log_path)[0], '%Y%m%d')
-        return last_log_path, date
+        date_section = re.findall(r'\d{8}', log_name)
+        if (ext == 'gz' or ext.startswith('log')) and date_section:
+            logs_info.append((f'{log_dir}/{log_name}', datetime.strptime(date_section[0], '%Y%m%d')))
+    return logs_info
+
+
+def get_last_logfile_info(log_dir: str) -> tuple:
+    logs_info = get_logfiles_info(log_dir)
+    if logs_info:
+        return logs_info[-1]
     else:
         return None, None
 
 
-def read_lines(log_path: str) -> str:
-    log_reader = gzip.open if log_path.endswith(".gz") else open
-    for line in log_reader(log_path, 'r'):
-        yield line.decode()
-
-
-def process_logfile(logfile_path: str, report_size: int, errors_threshold: float) -> list:
-    # urls_info = defaultdict(lambda: defaultdict(int))
-    urls_info = {}
-    total_lines_counter = 0
-    parsing_errors_counter = 0
-    total_urls_time = 0
-    regexp = re.compile(r'\"\w{3,4} (/.+?) ')
-    for line in read_lines(logfile_path):
-        total_lines_counter += 1
-        url_section = regexp.findall(line)
-        if url_section:
-            url = url_section[0]
-            request_time = float(line.split()[-1])
-            total_urls_time += request_time
-            urls_info[url] = {
-                'count': urls_info.get(url, {}).get('count', 0) + 1,
-                'time_sum': urls_info.get(url, {}).get('time_sum', 0) + request_time,
-                'timings': urls_info.get(url, {}).get('timings', []) + [request_time],
-            }
-        else:
-            parsing_errors_counter += 1
-    parsing_errors_ratio = round(parsing_errors_counter / total_lines_counter, 2)
+def read_lines(log_path: str) -> bytes:
+    if log_path.endswith(".gz"):
+        yield from read_gzip_lines(log_path)
+    else:
+        yield from read_mapped_lines(log_path)
+
+
+def aggregate_lines(lines, aggregator: Aggregator, parser: str = 'regex', parser_options: dict = None,
+                    stats: RunStats = None) -> Aggregator:
+    parse_line = create_parser(parser, parser_options)
+    lines_before, errors_before = aggregator.total_lines, aggregator.errors
+    if stats is not None and stats.detailed:
+        aggregate_blocks(lines, aggregator, parse_line, stats)
+    else:
+        with stats.stage('scan') if stats else nullcontext():
+            for line in lines:
+                parsed = parse_line(line)
+                if parsed:
+                    aggregator.add(*parsed)
+                else:
+                    aggregator.add_error()
+    if stats is not None:
+        stats.count('lines', aggregator.total_lines - lines_before)
+        stats.count('errors', aggregator.errors - errors_before)
+    return aggregator
+
+
+def aggregate_blocks(lines, aggregator: Aggregator, parse_line, stats: RunStats):
+    """The aggregation loop run block by block, timing reading (with decompression), parsing and
+    aggregation of every block separately."""
+    clock = time.perf_counter
+    while True:
+        started_at = clock()
+        block = list(islice(lines, STATS_BLOCK_LINES))
+        read_at = clock()
+        stats.add_time('read', read_at - started_at)
+        if not block:
+            return
+        parsed_lines = [parse_line(line) for line in block]
+        parsed_at = clock()
+        for parsed in parsed_lines:
+            if parsed:
+                aggregator.add(*parsed)
+            else:
+                aggregator.add_error()
+        stats.add_time('parse', parsed_at - read_at)
+        stats.add_time('aggregate', clock() - parsed_at)
+
+
+def process_range(log_path: str, start: int, end: int, engine: str = 'exact', parser: str = 'regex',
+                  engine_options: dict = None, parser_options: dict = None, detailed_stats: bool = False) -> tuple:
+    """Aggregates [start, end) of an uncompressed log; returns the aggregator and its RunStats."""
+    stats = RunStats(detailed_stats)
+    stats.count('bytes_read', end - start)
+    aggregator = aggregate_lines(
+        read_mapped_lines(log_path, start, end), create_aggregator(engine, engine_options), parser, parser_options,
+        stats
+    )
+    return aggregator, stats
+
+
+def aggregate_logfile(logfile_path: str, workers: int = 1, engine: str = 'exact', parser: str = 'regex',
+                      start: int = 0, end: int = None, engine_options: dict = None,
+                      parser_options: dict = None, stats: RunStats = None) -> Aggregator:
+    if stats is None:
+        stats = RunStats()
+    if workers > 1 and logfile_path.endswith('.gz'):
+        logger.info(f'Compressed log [{logfile_path}] can not be split, processing it in a single process.')
+        workers = 1
+    if workers <= 1:
+        if start == 0 and end is None:
+            stats.count('bytes_read', os.path.getsize(logfile_path))
+            return aggregate_lines(
+                read_lines(logfile_path), create_aggregator(engine, engine_options), parser, parser_options, stats
+            )
+        aggregator, range_stats = process_range(logfile_path, start, end, engine, parser, engine_options,
+                                                parser_options, stats.detailed)
+        stats.merge(range_stats)
+        return aggregator
+    with MappedLog(logfile_path) as mapped_log:
+        ranges = mapped_log.split_into_ranges(workers, start, end)
+    aggregator = create_aggregator(engine, engine_options)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(process_range, logfile_path, start, end, engine, parser, engine_options, parser_options,
+                            stats.detailed)
+            for start, end in ranges
+        ]
+        for future in futures:
+            range_aggregator, range_stats = future.result()
+            with stats.stage('merge'):
+                aggregator.merge(range_aggregator)
+            stats.merge(range_stats)
+    return aggregator
+
+
+def check_errors_ratio(aggregator: Aggregator, errors_threshold: float, logfile_path: str):
+    if not aggregator.total_lines:
+        # e.g. the newest log right after rotation, its report is empty
+        logger.info(f'Logfile {logfile_path} has no lines yet.')
+        return
+    parsing_errors_ratio = aggregator.errors_ratio
     if parsing_errors_ratio > errors_threshold:
         raise SystemError(
             f'Too many errors [{parsing_errors_ratio * 100} %] occurred during parsing logfile {logfile_path}'
         )
-    for url, info in urls_info.items():
-        urls_info[url]['url'] = url
-        urls_info[url]['count_perc'] = round(urls_info[url]['count'] / total_lines_counter * 100)
-        urls_info[url]['time_perc'] = round(urls_info[url]['time_sum'] / total_urls_time * 100)
-        urls_info[url]['time_sum'] = round(urls_info[url]['time_sum'], 3)
-        urls_info[url]['time_max'] = max(urls_info[url]['timings'])
-        urls_info[url]['time_avg'] = round(mean(urls_info[url]['timings']), 3)
-        urls_info[url]['time_med'] = round(median(urls_info[url]['timings']), 3)
-        del urls_info[url]['timings']
-    urls_table_data = []
-    for v in sorted(urls_info.values(), key=lambda item: item['time_sum'], reverse=True):
-        if len(urls_table_data) == report_size:
-            break
-        urls_table_data.append(v)
-    return urls_table_data
-
-
-def save_report(stats: list, reports_dir: str, date: datetime):
-    with open('report.html', encoding='utf-8') as template_file:
+
+
+def check_sample(logfile_path: str, errors_threshold: float, parser: str = 'regex',
+                 parser_options: dict = None) -> LogSample:
+    """Parses random blocks of the log and aborts early if the errors ratio is above the threshold
+    with 99 % confidence. An inconclusive sample is left to the full parse to decide.
+    """
+    sample = LogSample(logfile_path, parser, parser_options)
+    low, high = sample.errors_ratio_interval()
+    logger.info(
+        f'Sampled {sample.aggregator.total_lines} lines ({sample.coverage:.1%} of [{logfile_path}]), '
+        f'parsing errors ratio is within [{low:.3f}, {high:.3f}].'
+    )
+    if low > errors_threshold:
+        raise SystemError(
+            f'Too many errors [{low * 100:.1f}-{high * 100:.1f} %] occurred during parsing a sample of '
+            f'logfile {logfile_path}'
+        )
+    return sample
+
+
+def aggregate_incrementally(logfile_path: str, checkpoint_path: str, workers: int = 1, engine: str = 'exact',
+                            parser: str = 'regex', engine_options: dict = None, parser_options: dict = None,
+                            stats: RunStats = None) -> tuple:
+    """Resumes from the checkpoint saved by a previous run and parses only lines appended since then.
+
+    The checkpoint keeps the byte offset after the last complete line, the file inode and
+    the aggregator itself. It is discarded when the log was replaced (another inode),
+    truncated or aggregated with another engine, engine options or parser options. Compressed logs can not
+    be resumed in the middle, they are reused only when unchanged.
+    Returns the cumulative aggregator and the number of lines parsed by this run.
+    """
+    parser_options = parser_options or {}
+    engine_options = engine_options or {}
+    log_stat = os.stat(logfile_path)
+    state = load_state(checkpoint_path)
+    if (
+        state is None
+        or state['inode'] != log_stat.st_ino
+        or state['engine'] != engine
+        or state.get('engine_options') != engine_options
+        or state.get('parser_options') != parser_options
+        or state['offset'] > log_stat.st_size
+        or (logfile_path.endswith('.gz') and state['offset'] != log_stat.st_size)
+    ):
+        state = {'inode': log_stat.st_ino, 'engine': engine, 'engine_options': engine_options,
+                 'parser_options': parser_options, 'offset': 0, 'aggregator': create_aggregator(engine, engine_options)}
+    else:
+        logger.info(f'Resuming [{logfile_path}] from offset {state["offset"]}.')
+    aggregator = state['aggregator']
+    lines_before = aggregator.total_lines
+    if logfile_path.endswith('.gz'):
+        end = log_stat.st_size
+        if state['offset'] != end:
+            aggregator = aggregate_logfile(logfile_path, workers, engine, parser, engine_options=engine_options,
+                                           parser_options=parser_options, stats=stats)
+            lines_before = 0
+    else:
+        with MappedLog(logfile_path) as mapped_log:
+            end = mapped_log.last_line_end(state['offset'], log_stat.st_size)
+        if end > state['offset']:
+            aggregator.merge(
+                aggregate_logfile(
+                    logfile_path, workers, engine, parser, state['offset'], end, engine_options, parser_options,
+                    stats
+                )
+            )
+    state.update(offset=end, aggregator=aggregator)
+    with stats.stage('checkpoint') if stats else nullcontext():
+        save_state(checkpoint_path, state)
+    return aggregator, aggregator.total_lines - lines_before
+
+
+def process_logfile(logfile_path: str, report_size: int, errors_threshold: float, workers: int = 1,
+                    engine: str = 'exact', parser: str = 'regex', checkpoint_path: str = None,
+                    engine_options: dict = None, parser_options: dict = None, stats: RunStats = None) -> list:
+    if stats is None:
+        stats = RunStats()
+    started_at = time.perf_counter()
+    if checkpoint_path:
+        aggregator, parsed_lines = aggregate_incrementally(
+            logfile_path, checkpoint_path, workers, engine, parser, engine_options, parser_options, stats
+        )
+    else:
+        aggregator = aggregate_logfile(logfile_path, workers, engine, parser, engine_options=engine_options,
+                                       parser_options=parser_options, stats=stats)
+        parsed_lines = aggregator.total_lines
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f'Parsed {parsed_lines} lines in {elapsed:.2f} s '
+        f'({parsed_lines / elapsed:.0f} lines/sec, {parser} parser).'
+    )
+    check_errors_ratio(aggregator, errors_threshold, logfile_path)
+    stats.count('distinct_urls', aggregator.urls_count)
+    with stats.stage('statistics'):
+        return aggregator.report_table(report_size)
+
+
+def get_report_path(reports_dir: str, date: datetime) -> str:
+    return f'{reports_dir}/report-{date.strftime("%Y.%m.%d")}.html'
+
+
+def save_rows(stats: list, rows_path: str):
+    """Writes report rows as JSON lines, one row at a time: a header with column names
+    and the number of rows, then one array of values per row.
+    """
+    columns = list(stats[0]) if stats else []
+    with open(rows_path, 'w', encoding='utf-8') as rows_file:
+        rows_file.write(json.dumps({'columns': columns, 'rows': len(stats)}) + '\n')
+        for row in stats:
+            rows_file.write(json.dumps([row.get(column) for column in columns]) + '\n')
+
+
+def save_report(stats: list, reports_dir: str, date: datetime, report_path: str = None,
+                report_format: str = 'inline'):
+    report_path = report_path or get_report_path(reports_dir, date)
+    if report_format == 'paged':
+        # the sidecar goes first, an existing report means the day is done
+        rows_path = f'{os.path.splitext(report_path)[0]}.jsonl'
+        save_rows(stats, rows_path)
+        template_path, substitutions = PAGED_TEMPLATE_PATH, {'rows_url': os.path.basename(rows_path)}
+    else:
+        template_path, substitutions = 'report.html', {'table_json': stats}
+    with open(template_path, encoding='utf-8') as template_file:
         template = Template(template_file.read())
-        output_str = template.safe_substitute(table_json=stats)
-        with open(f'{reports_dir}/report-{date.strftime("%Y.%m.%d")}.html', 'w', encoding='utf-8') as report_file:
+        output_str = template.safe_substitute(**substitutions)
+        with open(report_path, 'w', encoding='utf-8') as report_file:
             report_file.write(output_str)
 
 
+def get_engine_options(config: dict) -> dict:
+    if config['ENGINE'] == 'topk':
+        return {'capacity': config['TOPK_CAPACITY']}
+    return {}
+
+
+def get_parser_options(config: dict) -> dict:
+    parser_options = {}
+    if config['URL_TEMPLATES']:
+        parser_options['url_templates'] = config['URL_TEMPLATES']
+    if config['PARSER'] == 'format' and config['LOG_FORMAT']:
+        parser_options['log_format'] = config['LOG_FORMATS'][config['LOG_FORMAT']]
+    return parser_options
+
+
+def get_aggregate_path(aggregates_dir: str, date: datetime, engine: str) -> str:
+    return f'{aggregates_dir}/{date.strftime("%Y%m%d")}.{engine}.aggregate'
+
+
+def process_day(logfile_path: str, date: datetime, config: dict) -> Aggregator:
+    """Builds the daily report from the cached daily aggregate, parsing the log only when there is none yet."""
+    aggregate_path = get_aggregate_path(config['AGGREGATES_DIR'], date, config['ENGINE'])
+    aggregator = load_state(aggregate_path)
+    if aggregator is None:
+        aggregator = aggregate_logfile(logfile_path, 1, config['ENGINE'], config['PARSER'],
+                                       engine_options=get_engine_options(config),
+                                       parser_options=get_parser_options(config))
+        check_errors_ratio(aggregator, config['ERRORS_THRESHOLD'], logfile_path)
+        save_state(aggregate_path, aggregator)
+    report_path = get_report_path(config['REPORT_DIR'], date)
+    if not os.path.exists(report_path):
+        save_report(aggregator.report_table(config['REPORT_SIZE']), config['REPORT_DIR'], date,
+                    report_format=config['REPORT_FORMAT'])
+    return aggregator
+
+
+ROLLUPS = {
+    'week': lambda date: date.strftime('%G.W%V'),
+    'month': lambda date: date.strftime('%Y.%m'),
+}
+
+
+def process_batch(config: dict):
+    """Processes every log in LOG_DIR whose daily report (or cached aggregate, for rollups) is missing,
+    several days at once, then builds rollup reports by merging cached daily aggregates.
+    """
+    if not os.path.exists(config['AGGREGATES_DIR']):
+        os.mkdir(config['AGGREGATES_DIR'])
+    logs_info = get_logfiles_info(config['LOG_DIR'])
+    pending = [
+        (logfile_path, date) for logfile_path, date in logs_info
+        if not os.path.exists(get_report_path(config['REPORT_DIR'], date))
+        or config['ROLLUP'] and not os.path.exists(get_aggregate_path(config['AGGREGATES_DIR'], date, config['ENGINE']))
+    ]
+    logger.info(f'Batch processing {len(pending)} of {len(logs_info)} logs.')
+    workers = config['WORKERS'] if config['WORKERS'] > 1 else os.cpu_count()
+    failed_dates = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_day, logfile_path, date, config): (logfile_path, date)
+                   for logfile_path, date in pending}
+        for future, (logfile_path, date) in futures.items():
+            try:
+                future.result()
+                logger.info(f'Log {logfile_path} successfully processed.')
+            except SystemError as e:
+                failed_dates.add(date)
+                logger.error(e)
+    if not config['ROLLUP']:
+        return
+    period_name = ROLLUPS[config['ROLLUP']]
+    periods = {}
+    for logfile_path, date in logs_info:
+        if date not in failed_dates:
+            periods.setdefault(period_name(date), []).append(date)
+    for period, dates in periods.items():
+        aggregator = create_aggregator(config['ENGINE'], get_engine_options(config))
+        for date in dates:
+            daily_aggregator = load_state(get_aggregate_path(config['AGGREGATES_DIR'], date, config['ENGINE']))
+            if daily_aggregator is None:
+                logger.error(f'No cached aggregate for {date.strftime("%Y.%m.%d")}, skipping it in {period} rollup.')
+                continue
+            aggregator.merge(daily_aggregator)
+        save_report(aggregator.report_table(config['REPORT_SIZE']), config['REPORT_DIR'], dates[0],
+                    f'{config["REPORT_DIR"]}/report-{period}.html', config['REPORT_FORMAT'])
+        logger.info(f'Rollup report for {period} built from {len(dates)} daily aggregates.')
+
+
+def follow_logs(config: dict, snapshots: int = None):
+    """Tails the newest uncompressed log in LOG_DIR and rewrites `live.json` in REPORT_DIR with
+    per-URL statistics of the last 5, 15 and 60 minutes every FOLLOW_INTERVAL seconds.
+
+    When a newer log appears in LOG_DIR, the current one is read to its end and the new one
+    is followed from its start. Runs until interrupted, or for `snapshots` snapshots.
+    """
+    windows = SlidingWindows(engine=config['ENGINE'], engine_options=get_engine_options(config))
+    parse_line = create_parser(config['PARSER'], get_parser_options(config))
+    snapshot_path = f'{config["REPORT_DIR"]}/live.json'
+    logfile_path, tail = None, None
+    try:
+        while snapshots is None or snapshots > 0:
+            latest_path, _ = get_last_logfile_info(config['LOG_DIR'])
+            # lines left in the previous log after switching to a newer one
+            lines = []
+            if latest_path and latest_path != logfile_path and not latest_path.endswith('.gz'):
+                if tail:
+                    lines = list(tail.lines())
+                    tail.close()
+                logger.info(f'Following [{latest_path}].')
+                tail = LogTail(latest_path, from_end=logfile_path is None)
+                logfile_path = latest_path
+            if tail:
+                aggregator = windows.bucket(time.time())
+                for line in chain(lines, tail.lines()):
+                    parsed = parse_line(line)
+                    if parsed:
+                        aggregator.add(*parsed)
+                    else:
+                        aggregator.add_error()
+            snapshot = windows.snapshot(time.time(), config['REPORT_SIZE'])
+            snapshot['log'] = logfile_path
+            save_snapshot(snapshot_path, snapshot)
+            if snapshots is not None:
+                snapshots -= 1
+                if not snapshots:
+                    break
+            time.sleep(config['FOLLOW_INTERVAL'])
+    except KeyboardInterrupt:
+        logger.info('Follow mode stopped.')
+    finally:
+        if tail:
+            tail.close()
+
+
 def get_config(default_config: dict) -> dict:
     parser = argparse.ArgumentParser('LogParser')
     parser.add_argument('--config')
+    parser.add_argument('--workers', type=int, help='parse an uncompressed log in N processes')
+    engine_group = parser.add_mutually_exclusive_group()
+    engine_group.add_argument('--engine', choices=sorted(ENGINES), help='per-URL aggregation engine')
+    engine_group.add_argument('--exact', dest='engine', action='store_const', const='exact',
+                              help='keep every request time and report exact statistics (default)')
+    parser.add_argument('--topk-capacity', type=int, help='max number of URLs tracked by the topk engine')
+    parser.add_argument('--parser', choices=sorted(PARSERS), help='log line parser')
+    parser.add_argument('--log-format', help='name of a [LOG_FORMATS] config entry, implies --parser format')
+    parser.add_argument('--incremental', action='store_true',
+                        help='resume from the last checkpoint and parse only newly appended lines')
+    parser.add_argument('--sample', action='store_true',
+                        help='check parsing errors on random blocks first and abort early if there are too many')
+    parser.add_argument('--approximate', action='store_true',
+                        help='build an approximate report with confidence intervals from random blocks only')
+    parser.add_argument('--batch', action='store_true', help='process every log in LOG_DIR that has no report yet')
+    parser.add_argument('--rollup', choices=sorted(ROLLUPS),
+                        help='batch mode plus reports merged from cached daily aggregates per week or month')
+    parser.add_argument('--follow', action='store_true',
+                        help='tail the newest log and keep a live.json snapshot of the last 5/15/60 minutes')
+    parser.add_argument('--follow-interval', type=int, help='seconds between live snapshots')
+    parser.add_argument('--report-format', choices=REPORT_FORMATS,
+                        help='inline: rows embedded into report.html; paged: rows in a JSON lines sidecar '
+                             'loaded page by page, for a large REPORT_SIZE')
+    parser.add_argument('--profile', nargs='?', const=PROFILE_PATH, metavar='PATH',
+                        help=f'run under cProfile and dump the stats to PATH ({PROFILE_PATH} by default)')
     args = parser.parse_args()
     config_path = args.config
     if config_path:
         if os.path.exists(config_path):
-            config = ConfigParser()
+            config = ConfigParser(interpolation=None)
             config.read(config_path)
-            if config.has_option('DEFAULT', 'REPORT_SIZE'):
-                default_config['REPORT_SIZE'] = config.getint('DEFAULT', 'REPORT_SIZE')
-            for option in ['REPORT_DIR', 'LOG_DIR']:
+            for option in ['REPORT_SIZE', 'TOPK_CAPACITY', 'FOLLOW_INTERVAL']:
+                if config.has_option('DEFAULT', option):
+                    default_config[option] = config.getint('DEFAULT', option)
+            for option in ['REPORT_DIR', 'LOG_DIR', 'CHECKPOINT_DIR', 'AGGREGATES_DIR', 'REPORT_FORMAT', 'LOG_FORMAT']:
                 if config.has_option('DEFAULT', option):
                     default_config[option] = config.get('DEFAULT', option)
+            if config.has_section('URL_TEMPLATES'):
+                default_config['URL_TEMPLATES'] = [
+                    (name, pattern) for name, pattern in config.items('URL_TEMPLATES')
+                    if name not in config.defaults()
+                ]
+            if config.has_section('LOG_FORMATS'):
+                default_config['LOG_FORMATS'] = dict(default_config['LOG_FORMATS'], **{
+                    name: log_format for name, log_format in config.items('LOG_FORMATS')
+                    if name not in config.defaults()
+                })
         else:
             raise FileNotFoundError
+    if args.workers:
+        default_config['WORKERS'] = args.workers
+    if args.engine:
+        default_config['ENGINE'] = args.engine
+    if args.topk_capacity:
+        default_config['TOPK_CAPACITY'] = args.topk_capacity
+    if args.parser:
+        default_config['PARSER'] = args.parser
+    if args.log_format:
+        default_config['LOG_FORMAT'] = args.log_format
+    if default_config['LOG_FORMAT']:
+        if default_config['LOG_FORMAT'] not in default_config['LOG_FORMATS']:
+            raise ValueError(f'Unknown log format {default_config["LOG_FORMAT"]}, '
+                             f'known ones are {", ".join(sorted(default_config["LOG_FORMATS"]))}')
+        if not args.parser:
+            default_config['PARSER'] = 'format'
+    if args.incremental:
+        default_config['INCREMENTAL'] = True
+    if args.sample:
+        default_config['SAMPLE'] = True
+    if args.approximate:
+        default_config['APPROXIMATE'] = True
+    if args.batch:
+        default_config['BATCH'] = True
+    if args.rollup:
+        default_config['ROLLUP'] = args.rollup
+    if args.follow:
+        default_config['FOLLOW'] = True
+    if args.follow_interval:
+        default_config['FOLLOW_INTERVAL'] = args.follow_interval
+    if args.report_format:
+        default_config['REPORT_FORMAT'] = args.report_format
+    if args.profile:
+        default_config['PROFILE'] = args.profile
+    if (
+        (default_config['INCREMENTAL'] or default_config['BATCH'] or default_config['ROLLUP'])
+        and default_config['ENGINE'] not in COMPACT_ENGINES
+    ):
+        # checkpoints and cached aggregates of exact engines keep every request time and are rewritten every run
+        if args.engine:
+            raise ValueError(f'The {args.engine} engine can not be used with --incremental, --batch or --rollup, '
+                             f'its checkpoints grow with the log; use one of {", ".join(COMPACT_ENGINES)}')
+        logger.info(f'Using the sketch engine instead of {default_config["ENGINE"]} for checkpoints.')
+        default_config['ENGINE'] = 'sketch'
     return default_config
 
 
+def analyze(config: dict):
+    if not os.path.exists(config['REPORT_DIR']):
+        os.mkdir(config['REPORT_DIR'])
+    if config['FOLLOW']:
+        follow_logs(config)
+        return
+    if config['BATCH'] or config['ROLLUP']:
+        process_batch(config)
+        return
+    logfile_path, date = get_last_logfile_info(config['LOG_DIR'])
+    if not logfile_path:
+        logger.info('No logs was found to process.')
+        return
+    logger.info(f'Processing [{logfile_path}] file.')
+    checkpoint_path = None
+    if config['INCREMENTAL']:
+        if not os.path.exists(config['CHECKPOINT_DIR']):
+            os.mkdir(config['CHECKPOINT_DIR'])
+        checkpoint_path = f'{config["CHECKPOINT_DIR"]}/{os.path.basename(logfile_path)}.checkpoint'
+    elif os.path.exists(get_report_path(config['REPORT_DIR'], date)):
+        logger.info(f'Report for [{logfile_path}] already exists.')
+        return
+    # the separate read/parse/aggregate timings are only worth their cost when profiling
+    run_stats = RunStats(detailed=bool(config['PROFILE']))
+    started_at = time.perf_counter()
+    if config['SAMPLE'] or config['APPROXIMATE']:
+        with run_stats.stage('sample'):
+            sample = check_sample(logfile_path, config['ERRORS_THRESHOLD'], config['PARSER'],
+                                  get_parser_options(config))
+        if config['APPROXIMATE']:
+            save_report(sample.report_table(config['REPORT_SIZE']), config['REPORT_DIR'], date,
+                        report_format=config['REPORT_FORMAT'])
+            logger.info(f'Approximate report for {logfile_path} built from {sample.coverage:.1%} of the log.')
+            return
+    stats = process_logfile(logfile_path, config['REPORT_SIZE'], config['ERRORS_THRESHOLD'],
+                            config['WORKERS'], config['ENGINE'], config['PARSER'], checkpoint_path,
+                            get_engine_options(config), get_parser_options(config), run_stats)
+    with run_stats.stage('render'):
+        save_report(stats, config['REPORT_DIR'], date, report_format=config['REPORT_FORMAT'])
+    run_stats.add_time('total', time.perf_counter() - started_at)
+    logger.info(run_stats)
+    logger.info(f'Log {logfile_path} successfully processed.')
+
+
 def main():
     try:
         config = get_config(DEFAULT_CONFIG)
-        if not os.path.exists(config['REPORT_DIR']):
-            os.mkdir(config['REPORT_DIR'])
-        logfile_path, date = get_last_logfile_info(config['LOG_DIR'])
-        if not logfile_path:
-            logger.info('No logs was found to process.')
-            return
-        logger.info(f'Processing [{logfile_path}] file.')
-        if os.path.exists(f'{config["REPORT_DIR"]}/report-{date.strftime("%Y.%m.%d")}.html'):
-            logger.info(f'Report for [{logfile_path}] already exists.')
-            return
-        stats = process_logfile(logfile_path, config['REPORT_SIZE'], config['ERRORS_THRESHOLD'])
-        save_report(stats, config['REPORT_DIR'], date)
-        logger.info(f'Log {logfile_path} successfully processed.')
+        if config['PROFILE']:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                analyze(config)
+            finally:
+                profiler.disable()
+                profiler.dump_stats(config['PROFILE'])
+                logger.info(f'Profile saved to {config["PROFILE"]}.')
+        else:
+            analyze(config)
 
     except (SystemError, FileNotFoundError) as e:
         logger.error(e)
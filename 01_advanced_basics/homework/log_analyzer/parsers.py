@@ -0,0 +1,179 @@
+import re
+from functools import lru_cache
+
+URL_REGEXP = re.compile(r'\"\w{3,4} (/.+?) ')
+
+
+class RegexParser:
+    """Decodes every line and extracts the URL with a regexp and request time with split()."""
+
+    def __call__(self, line: bytes):
+        line = line.decode()
+        url_section = URL_REGEXP.findall(line)
+        if not url_section:
+            return None
+        try:
+            return url_section[0], float(line.split()[-1])
+        except ValueError:
+            return None
+
+
+class BytesParser:
+    """Scans raw bytes for delimiters instead of decoding and matching every line.
+
+    The URL is taken from the first quoted field ("METHOD /url ..."), request time is the
+    last field. URL keys are decoded once, the first time they are seen.
+    """
+
+    def __init__(self):
+        self.urls = {}
+
+    def __call__(self, line: bytes):
+        quote = line.find(b'"')
+        if quote < 0:
+            return None
+        method_end = line.find(b' ', quote + 1)
+        if not 4 <= method_end - quote <= 5 or not line[quote + 1:method_end].isalnum():
+            return None
+        url_end = line.find(b' ', method_end + 3)
+        if url_end < 0 or line[method_end + 1] != 0x2F:
+            return None
+        try:
+            request_time = float(line[line.rfind(b' ') + 1:])
+        except ValueError:
+            return None
+        raw_url = line[method_end + 1:url_end]
+        url = self.urls.get(raw_url)
+        if url is None:
+            url = self.urls[raw_url] = raw_url.decode()
+        return url, request_time
+
+
+LOG_FORMAT_VARIABLE = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+# variables the URL can be taken from, in order of preference
+URL_VARIABLES = ('request', 'request_uri', 'uri')
+TIME_VARIABLE = 'request_time'
+# nginx `ui_short` format the regex and bytes parsers are written for
+DEFAULT_LOG_FORMAT = (
+    '$remote_addr $remote_user  $http_x_real_ip [$time_local] "$request" $status $body_bytes_sent '
+    '"$http_referer" "$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+    '$request_time'
+)
+
+
+def tokenize_log_format(log_format: str) -> list:
+    """Splits an nginx `log_format` string into ('literal', text) and ('variable', name) tokens."""
+    tokens = []
+    position = 0
+    for match in LOG_FORMAT_VARIABLE.finditer(log_format):
+        if match.start() > position:
+            tokens.append(('literal', log_format[position:match.start()]))
+        tokens.append(('variable', match.group(1) or match.group(2)))
+        position = match.end()
+    if position < len(log_format):
+        tokens.append(('literal', log_format[position:]))
+    return tokens
+
+
+class FormatParser:
+    """Parser compiled once from an nginx `log_format` spec.
+
+    The format becomes a bytes regexp that captures only the URL (from $request, $request_uri
+    or $uri) and $request_time; other variables are skipped up to the next literal, and the
+    regexp ends right after the last field it needs. If $request_time ends the line, it is
+    taken after the last separator instead, so the fields in between are never scanned.
+    URL keys are decoded once, the first time they are seen.
+    """
+
+    def __init__(self, log_format: str = DEFAULT_LOG_FORMAT):
+        tokens = tokenize_log_format(log_format)
+        names = {value for kind, value in tokens if kind == 'variable'}
+        url_variable = next((name for name in URL_VARIABLES if name in names), None)
+        if url_variable is None or TIME_VARIABLE not in names:
+            raise ValueError(f'log_format must contain $request (or $request_uri, $uri) and ${TIME_VARIABLE}: '
+                             f'{log_format!r}')
+        self.time_separator = None
+        if len(tokens) > 1 and tokens[-1] == ('variable', TIME_VARIABLE) and tokens[-2][0] == 'literal':
+            self.time_separator = tokens[-2][1][-1].encode()
+            tokens = tokens[:-2]
+        needed = {url_variable} if self.time_separator else {url_variable, TIME_VARIABLE}
+        last_needed = max(index for index, (kind, value) in enumerate(tokens) if value in needed and kind == 'variable')
+        parts = []
+        for index, (kind, value) in enumerate(tokens[:last_needed + 1]):
+            if kind == 'literal':
+                parts.append(re.escape(value.encode()))
+                continue
+            following = tokens[index + 1] if index + 1 < len(tokens) else None
+            stop = re.escape(following[1][0].encode()) if following and following[0] == 'literal' else None
+            field = b'[^' + stop + b']*' if stop else rb'\S*'
+            if value == url_variable and value == 'request':
+                parts.append(rb'[A-Za-z]+ (?P<url>/[^ ]*) ' + (field if stop else rb'.*?'))
+            elif value == url_variable:
+                parts.append(b'(?P<url>/' + field + b')')
+            elif value == TIME_VARIABLE and not self.time_separator:
+                parts.append(b'(?P<time>' + field + b')')
+            else:
+                parts.append(field)
+        self.regexp = re.compile(b''.join(parts))
+        self.url_group = self.regexp.groupindex['url']
+        self.time_group = self.regexp.groupindex.get('time')
+        self.urls = {}
+
+    def __call__(self, line: bytes):
+        match = self.regexp.match(line)
+        if match is None:
+            return None
+        raw_url = match.group(self.url_group)
+        if self.time_separator:
+            raw_time = line[line.rfind(self.time_separator) + 1:]
+        else:
+            raw_time = match.group(self.time_group)
+        try:
+            request_time = float(raw_time)
+        except ValueError:
+            return None
+        url = self.urls.get(raw_url)
+        if url is None:
+            url = self.urls[raw_url] = raw_url.decode()
+        return url, request_time
+
+
+PARSERS = {
+    'regex': RegexParser,
+    'bytes': BytesParser,
+    'format': FormatParser,
+}
+
+
+class UrlNormalizer:
+    """Maps URLs to templates before aggregation, e.g. /api/v2/banner/25019354 -> /api/v2/banner/{id}.
+
+    Every (name, pattern) rule replaces its matches with {name}; rules are compiled once
+    and applied in order. Recent results are kept in an LRU cache, so hot URLs cost one lookup.
+    """
+
+    def __init__(self, url_templates: list, cache_size: int = 64 * 1024):
+        self.rules = [(re.compile(pattern), f'{{{name}}}') for name, pattern in url_templates]
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _normalize(self, url: str) -> str:
+        for regexp, placeholder in self.rules:
+            url = regexp.sub(placeholder, url)
+        return url
+
+
+def create_parser(parser: str = 'regex', parser_options: dict = None):
+    parser_options = dict(parser_options or {})
+    url_templates = parser_options.pop('url_templates', None)
+    parse_line = PARSERS[parser](**parser_options)
+    if not url_templates:
+        return parse_line
+    normalize_url = UrlNormalizer(url_templates).normalize
+
+    def parse_normalized_line(line: bytes):
+        parsed = parse_line(line)
+        if parsed:
+            return normalize_url(parsed[0]), parsed[1]
+        return None
+
+    return parse_normalized_line
@@ -0,0 +1,170 @@
+import gzip
+import mmap
+import os
+import queue
+import shutil
+import subprocess
+import threading
+
+BLOCK_SIZE = 1024 * 1024
+QUEUE_SIZE = 8
+DECOMPRESSORS = ('pigz', 'gzip')
+
+
+def find_decompressor() -> str:
+    """Returns an external decompressor, if there is a spare core for it to run on."""
+    if (os.cpu_count() or 1) < 2:
+        return None
+    for name in DECOMPRESSORS:
+        path = shutil.which(name)
+        if path:
+            return path
+    return None
+
+
+def _put(chunks: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _decompress(log_path: str, block_size: int, chunks: queue.Queue, stop: threading.Event):
+    """Reader thread: decompresses big blocks and puts newline-aligned chunks into the queue.
+
+    An external pigz/gzip process is used when available, so decompression runs on its own core;
+    otherwise zlib is used in this thread (it releases the GIL while inflating).
+    """
+    decompressor = find_decompressor()
+    process = None
+    try:
+        if decompressor:
+            process = subprocess.Popen([decompressor, '-dc', log_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stream = process.stdout
+        else:
+            stream = gzip.open(log_path, 'rb')
+        with stream:
+            tail = b''
+            while not stop.is_set():
+                block = stream.read(block_size)
+                if not block:
+                    break
+                block = tail + block
+                cut = block.rfind(b'\n') + 1
+                tail = block[cut:]
+                if cut and not _put(chunks, block[:cut], stop):
+                    return
+            if stop.is_set():
+                return
+            if process and process.wait() != 0:
+                raise OSError(f'{decompressor} failed on [{log_path}]: {process.stderr.read().decode().strip()}')
+            if tail:
+                _put(chunks, tail, stop)
+        _put(chunks, None, stop)
+    except Exception as e:
+        _put(chunks, e, stop)
+    finally:
+        if process:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stderr.close()
+
+
+def read_gzip_chunks(log_path: str, block_size: int = BLOCK_SIZE, queue_size: int = QUEUE_SIZE) -> bytes:
+    """Yields newline-aligned chunks of a .gz log decompressed in a background thread.
+
+    The bounded queue lets decompression run ahead of parsing by at most `queue_size` chunks.
+    """
+    chunks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    reader = threading.Thread(target=_decompress, args=(log_path, block_size, chunks, stop), daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        stop.set()
+        reader.join()
+
+
+def read_gzip_lines(log_path: str) -> bytes:
+    """Yields lines of a .gz log (without trailing newlines) split from pipelined chunks."""
+    for chunk in read_gzip_chunks(log_path):
+        lines = chunk.split(b'\n')
+        if not lines[-1]:
+            lines.pop()
+        yield from lines
+
+
+class MappedLog:
+    """Memory-mapped uncompressed log with the byte-range API used by parallel and incremental processing.
+
+    Newlines are searched in the mapping directly, and lines are read with mmap.readline,
+    which skips the buffered file layer.
+    """
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self.file = open(log_path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        # an empty file can not be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def split_into_ranges(self, parts: int, start: int = 0, end: int = None) -> list:
+        """Splits the log (or its [start, end) part) into byte ranges aligned to line boundaries."""
+        if end is None:
+            end = self.size
+        if start >= end:
+            return []
+        boundaries = [start]
+        for part in range(1, parts):
+            newline = self.map.find(b'\n', max(start + (end - start) * part // parts, boundaries[-1]), end)
+            boundaries.append(end if newline < 0 else newline + 1)
+        boundaries.append(end)
+        return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+    def last_line_end(self, start: int = 0, end: int = None) -> int:
+        """Returns the offset right after the last newline in [start, end), or `start` if there is none."""
+        if end is None:
+            end = self.size
+        if start >= end:
+            return start
+        return self.map.rfind(b'\n', start, end) + 1 or start
+
+    def lines(self, start: int = 0, end: int = None) -> bytes:
+        if end is None:
+            end = self.size
+        if start >= end:
+            return
+        self.map.seek(start)
+        readline = self.map.readline
+        position = start
+        while position < end:
+            line = readline()
+            position += len(line)
+            yield line
+
+
+def read_mapped_lines(log_path: str, start: int = 0, end: int = None) -> bytes:
+    with MappedLog(log_path) as mapped_log:
+        yield from mapped_log.lines(start, end)
@@ -0,0 +1,138 @@
+import gzip
+import os
+import random
+from math import sqrt
+
+from aggregators import ExactAggregator
+from parsers import create_parser
+from readers import MappedLog
+
+SAMPLE_BLOCKS = 64
+SAMPLE_BLOCK_SIZE = 64 * 1024
+# two-sided 99 % confidence
+Z_SCORE = 2.576
+
+
+def wilson_interval(successes: int, trials: int, z: float = Z_SCORE) -> tuple:
+    """Wilson score interval of a binomial proportion."""
+    if not trials:
+        return 0.0, 1.0
+    p = successes / trials
+    denominator = 1 + z * z / trials
+    center = (p + z * z / (2 * trials)) / denominator
+    half_width = z * sqrt(p * (1 - p) / trials + z * z / (4 * trials * trials)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+class LogSample:
+    """Random blocks spread across a log, parsed into an exact aggregator.
+
+    An uncompressed log is split into `blocks` equal strata and one random block of
+    `block_size` bytes is read from each, keeping only complete lines. A compressed log can
+    not be read at random offsets, so the first `blocks * block_size` decompressed bytes are
+    used instead, which is only representative if the log is homogeneous over the day.
+    Totals are extrapolated by the share of the log the sample covers.
+    """
+
+    def __init__(self, log_path: str, parser: str = 'regex', parser_options: dict = None,
+                 blocks: int = SAMPLE_BLOCKS, block_size: int = SAMPLE_BLOCK_SIZE, seed: int = None):
+        self.log_path = log_path
+        self.aggregator = ExactAggregator()
+        # (lines, errors) per block, blocks are the sampling units for the errors ratio interval
+        self.blocks = []
+        parse_line = create_parser(parser, parser_options)
+        for block in self._read_blocks(blocks, block_size, random.Random(seed)):
+            lines_before, errors_before = self.aggregator.total_lines, self.aggregator.errors
+            for line in block.split(b'\n'):
+                parsed = parse_line(line)
+                if parsed:
+                    self.aggregator.add(*parsed)
+                else:
+                    self.aggregator.add_error()
+            self.blocks.append((self.aggregator.total_lines - lines_before, self.aggregator.errors - errors_before))
+
+    def _read_blocks(self, blocks: int, block_size: int, rnd: random.Random):
+        if self.log_path.endswith('.gz'):
+            with open(self.log_path, 'rb') as raw_file, gzip.GzipFile(fileobj=raw_file) as log_file:
+                for _ in range(blocks):
+                    block = log_file.read(block_size) + log_file.readline()
+                    if not block:
+                        break
+                    yield block.rstrip(b'\n')
+                compressed_size = os.path.getsize(self.log_path)
+                self.coverage = 1.0 if not log_file.read(1) else min(1.0, raw_file.tell() / compressed_size)
+            return
+        with MappedLog(self.log_path) as mapped_log:
+            if mapped_log.size <= blocks * block_size:
+                self.coverage = 1.0
+                if mapped_log.size:
+                    yield mapped_log.map[:mapped_log.size].rstrip(b'\n')
+                return
+            sampled_bytes = 0
+            for block_number in range(blocks):
+                stratum_start = mapped_log.size * block_number // blocks
+                stratum_end = mapped_log.size * (block_number + 1) // blocks
+                start = rnd.randint(stratum_start, stratum_end - block_size)
+                if start:
+                    # skip the partial line the block starts in
+                    newline = mapped_log.map.find(b'\n', start - 1, start + block_size)
+                    if newline < 0:
+                        continue
+                    start = newline + 1
+                end = mapped_log.last_line_end(start, min(start + block_size, mapped_log.size))
+                if end <= start:
+                    continue
+                sampled_bytes += end - start
+                yield mapped_log.map[start:end - 1]
+            self.coverage = sampled_bytes / mapped_log.size
+
+    @property
+    def scale(self) -> float:
+        return 1 / self.coverage if self.coverage else 0
+
+    @property
+    def estimated_lines(self) -> int:
+        return round(self.aggregator.total_lines * self.scale)
+
+    def errors_ratio_interval(self, z: float = Z_SCORE) -> tuple:
+        """Confidence interval of the parsing errors ratio (exact if the whole log was read).
+
+        Lines of one block are not independent (a bad hour gives a run of broken lines),
+        so the interval covers both the Wilson and the cluster (block-level) intervals.
+        """
+        lines, errors = self.aggregator.total_lines, self.aggregator.errors
+        if self.coverage == 1 and lines:
+            return errors / lines, errors / lines
+        low, high = wilson_interval(errors, lines, z)
+        if len(self.blocks) > 1 and lines:
+            ratio = errors / lines
+            mean_lines = lines / len(self.blocks)
+            variance = sum(
+                ((block_errors - ratio * block_lines) / mean_lines) ** 2 for block_lines, block_errors in self.blocks
+            ) / (len(self.blocks) * (len(self.blocks) - 1))
+            half_width = z * sqrt(variance)
+            low, high = min(low, max(0.0, ratio - half_width)), max(high, min(1.0, ratio + half_width))
+        return low, high
+
+    def report_table(self, report_size: int, z: float = Z_SCORE) -> list:
+        """Approximate report: counts and time sums are extrapolated to the whole log
+        and come with `count_ci` / `time_sum_ci` confidence intervals.
+        Averages, medians and shares are taken from the sample as is; time_max is a lower bound.
+        """
+        lines = self.aggregator.total_lines
+        sums_of_squares = {
+            url: sum(timing * timing for timing in info['timings']) for url, info in self.aggregator.urls_info.items()
+        }
+        urls_table_data = self.aggregator.report_table(report_size)
+        for row in urls_table_data:
+            count_low, count_high = wilson_interval(row['count'], lines, z)
+            mean_time = row['time_sum'] / lines
+            time_sum_half_width = z * sqrt(max(0.0, sums_of_squares[row['url']] / lines - mean_time ** 2) / lines)
+            row['count'] = round(row['count'] * self.scale)
+            row['count_ci'] = [round(count_low * self.estimated_lines), round(count_high * self.estimated_lines)]
+            row['time_sum'] = round(row['time_sum'] * self.scale, 3)
+            row['time_sum_ci'] = [
+                round(max(0.0, mean_time - time_sum_half_width) * self.estimated_lines, 3),
+                round((mean_time + time_sum_half_width) * self.estimated_lines, 3),
+            ]
+        return urls_table_data
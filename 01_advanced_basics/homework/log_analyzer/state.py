@@ -0,0 +1,23 @@
+import os
+import pickle
+
+from logger import logger
+
+
+def save_state(path: str, state):
+    """Writes state to a temporary file first, so an interrupted run never leaves a truncated file."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as state_file:
+        pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_state(path: str):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as state_file:
+            return pickle.load(state_file)
+    except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+        logger.error(f'Can not load state from [{path}]: {e}')
+        return None
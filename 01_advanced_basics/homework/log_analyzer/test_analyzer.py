@@ -1,6 +1,43 @@
+import gzip
+import json
+import os
+import random
+import tempfile
 import unittest
 import sys
-from log_analyzer import get_config
+from unittest import mock
+from aggregators import CountMinSketch, QuantileSketch, np
+from benchmark import find_regressions, run_benchmark
+from follow import LogTail, SlidingWindows
+from generator import generate_log
+from instrumentation import RunStats
+from log_analyzer import (
+    DEFAULT_CONFIG, check_sample, get_config, get_parser_options, process_batch, process_logfile, read_lines
+)
+from parsers import BytesParser, FormatParser, RegexParser, UrlNormalizer, create_parser
+from readers import MappedLog, read_gzip_chunks, read_gzip_lines
+from sampling import LogSample
+from state import load_state
+
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET {url} HTTP/1.1" 200 927 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+    '"dc7161be3" {request_time}\n'
+)
+
+
+def write_sample_log(log_dir: str, lines_count: int = 2000, name: str = 'nginx-access-ui.log-20170630',
+                     urls_count: int = 50) -> str:
+    rnd = random.Random(42)
+    log_path = os.path.join(log_dir, name)
+    with open(log_path, 'w', encoding='utf-8') as log_file:
+        for _ in range(lines_count):
+            if rnd.random() < 0.01:
+                log_file.write('broken line\n')
+                continue
+            url = f'/api/v2/banner/{int(rnd.paretovariate(1)) % urls_count}'
+            log_file.write(LOG_LINE.format(url=url, request_time=f'{rnd.expovariate(5):.3f}'))
+    return log_path
 
 
 class TestAnalyzer(unittest.TestCase):
@@ -11,6 +48,454 @@ class TestAnalyzer(unittest.TestCase):
                 {'foo': 'bar'}
             )
 
+    def test_checkpoints_use_compact_engine(self):
+        with mock.patch.object(sys, 'argv', ['log_analyzer.py', '--incremental']):
+            self.assertEqual(get_config(dict(DEFAULT_CONFIG))['ENGINE'], 'sketch')
+        with mock.patch.object(sys, 'argv', ['log_analyzer.py', '--batch', '--engine', 'topk']):
+            self.assertEqual(get_config(dict(DEFAULT_CONFIG))['ENGINE'], 'topk')
+        with mock.patch.object(sys, 'argv', ['log_analyzer.py', '--rollup', 'week', '--exact']):
+            with self.assertRaises(ValueError):
+                get_config(dict(DEFAULT_CONFIG))
+
+
+class TestProcessLogfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = write_sample_log(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_workers_match_single_process(self):
+        expected = process_logfile(self.log_path, 100, 0.2)
+        self.assertEqual(process_logfile(self.log_path, 100, 0.2, workers=3), expected)
+
+    def test_sketch_engine_error_bound(self):
+        exact = {row['url']: row for row in process_logfile(self.log_path, 100, 0.2)}
+        for row in process_logfile(self.log_path, 100, 0.2, workers=2, engine='sketch'):
+            expected = exact[row['url']]
+            self.assertEqual(row['count'], expected['count'])
+            self.assertAlmostEqual(row['time_sum'], expected['time_sum'], places=3)
+            self.assertEqual(row['time_max'], expected['time_max'])
+            self.assertIn('time_p99', row)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_numpy_engine_matches_exact(self):
+        expected = process_logfile(self.log_path, 100, 0.2)
+        rows = {row['url']: row for row in process_logfile(self.log_path, 100, 0.2, workers=2, engine='numpy')}
+        self.assertEqual(set(rows), {row['url'] for row in expected})
+        for expected_row in expected:
+            row = rows[expected_row['url']]
+            for key in ('count', 'count_perc', 'time_perc', 'time_sum', 'time_max', 'time_avg', 'time_med'):
+                self.assertAlmostEqual(row[key], expected_row[key], delta=0.0011, msg=key)
+
+    def test_run_stats_cover_workers(self):
+        stats = RunStats(detailed=True)
+        process_logfile(self.log_path, 100, 0.2, workers=2, stats=stats)
+        record = stats.record()
+        self.assertEqual(record['counters']['lines'], 2000)
+        self.assertEqual(record['counters']['bytes_read'], os.path.getsize(self.log_path))
+        self.assertGreater(record['counters']['distinct_urls'], 0)
+        self.assertTrue({'read', 'parse', 'aggregate', 'merge', 'statistics'} <= set(record['stages']))
+        self.assertGreater(record['lines_per_sec'], 0)
+
+    def test_run_stats_default_scan(self):
+        stats = RunStats()
+        rows = process_logfile(self.log_path, 100, 0.2, stats=stats)
+        self.assertEqual(rows, process_logfile(self.log_path, 100, 0.2, stats=RunStats(detailed=True)))
+        record = stats.record()
+        self.assertEqual(record['counters']['lines'], 2000)
+        self.assertIn('scan', record['stages'])
+        self.assertNotIn('parse', record['stages'])
+
+    def test_bytes_parser_matches_regex(self):
+        expected = process_logfile(self.log_path, 100, 0.2)
+        self.assertEqual(process_logfile(self.log_path, 100, 0.2, parser='bytes'), expected)
+
+    def test_incremental_resumes_from_checkpoint(self):
+        checkpoint_path = os.path.join(self.tmp_dir.name, 'log.checkpoint')
+        with open(self.log_path, 'rb') as log_file:
+            content = log_file.read()
+        half = len(content) // 2
+        with open(self.log_path, 'wb') as log_file:
+            log_file.write(content[:half])
+        process_logfile(self.log_path, 100, 0.2, checkpoint_path=checkpoint_path)
+        with open(self.log_path, 'ab') as log_file:
+            log_file.write(content[half:])
+        rows = process_logfile(self.log_path, 100, 0.2, checkpoint_path=checkpoint_path)
+        self.assertEqual(rows, process_logfile(self.log_path, 100, 0.2))
+        self.assertEqual(load_state(checkpoint_path)['offset'], len(content))
+
+    def test_empty_log(self):
+        checkpoint_path = os.path.join(self.tmp_dir.name, 'log.checkpoint')
+        open(self.log_path, 'w').close()
+        for engine in ('exact', 'sketch', 'topk'):
+            self.assertEqual(process_logfile(self.log_path, 100, 0.2, engine=engine), [])
+        self.assertEqual(process_logfile(self.log_path, 100, 0.2, engine='sketch', checkpoint_path=checkpoint_path), [])
+        self.assertEqual(load_state(checkpoint_path)['offset'], 0)
+
+    def test_checkpoint_of_other_engine_options_is_discarded(self):
+        checkpoint_path = os.path.join(self.tmp_dir.name, 'log.checkpoint')
+        process_logfile(self.log_path, 100, 0.2, engine='topk', checkpoint_path=checkpoint_path,
+                        engine_options={'capacity': 20})
+        process_logfile(self.log_path, 100, 0.2, engine='topk', checkpoint_path=checkpoint_path,
+                        engine_options={'capacity': 30})
+        state = load_state(checkpoint_path)
+        self.assertEqual((state['aggregator'].capacity, state['aggregator'].total_lines), (30, 2000))
+
+    def test_topk_engine_error_bounds(self):
+        log_path = write_sample_log(self.tmp_dir.name, 5000, 'nginx-access-ui.log-20170701', urls_count=500)
+        exact = {row['url']: row for row in process_logfile(log_path, 1000, 0.2)}
+        rows = process_logfile(log_path, 10, 0.2, workers=2, engine='topk', engine_options={'capacity': 20})
+        self.assertEqual(len(rows), 10)
+        for row in rows:
+            expected = exact[row['url']]
+            self.assertLessEqual(row['time_sum'] - row['time_sum_err'], expected['time_sum'] + 0.001)
+            self.assertGreaterEqual(row['time_sum'] + 0.001, expected['time_sum'])
+            self.assertLessEqual(row['count'] - row['count_err'], expected['count'])
+            self.assertGreaterEqual(row['count'], expected['count'])
+        self.assertEqual(rows[0]['url'], max(exact.values(), key=lambda row: row['time_sum'])['url'])
+
+    def test_url_templates(self):
+        rows = process_logfile(self.log_path, 100, 0.2, parser_options={'url_templates': [('id', r'(?<=/)\d+$')]})
+        self.assertEqual([row['url'] for row in rows], ['/api/v2/banner/{id}'])
+        self.assertEqual(rows[0]['count'], sum(row['count'] for row in process_logfile(self.log_path, 100, 0.2)))
+
+    def test_gzip_pipeline(self):
+        gz_path = f'{self.log_path}.gz'
+        with open(self.log_path, 'rb') as log_file, gzip.open(gz_path, 'wb') as gz_file:
+            gz_file.write(log_file.read())
+        expected = process_logfile(self.log_path, 100, 0.2)
+        self.assertEqual(process_logfile(gz_path, 100, 0.2), expected)
+        with mock.patch('readers.DECOMPRESSORS', ()):
+            self.assertEqual(process_logfile(gz_path, 100, 0.2, parser='bytes'), expected)
+        with mock.patch('os.cpu_count', return_value=4):
+            self.assertEqual(process_logfile(gz_path, 100, 0.2, parser='bytes'), expected)
+        with open(self.log_path, 'rb') as log_file:
+            expected_lines = log_file.read().split(b'\n')[:-1]
+        self.assertEqual(list(read_gzip_lines(gz_path)), expected_lines)
+        chunks = read_gzip_chunks(gz_path, block_size=100, queue_size=1)
+        self.assertTrue(next(chunks).endswith(b'\n'))
+        chunks.close()
+
+    def test_errors_threshold(self):
+        with self.assertRaises(SystemError):
+            process_logfile(self.log_path, 100, 0.001)
+
+
+class TestSampling(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = write_sample_log(self.tmp_dir.name, 20000)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_sample_estimates(self):
+        sample = LogSample(self.log_path, blocks=32, block_size=8 * 1024, seed=1)
+        self.assertLess(sample.coverage, 0.5)
+        self.assertAlmostEqual(sample.estimated_lines, 20000, delta=2000)
+        low, high = sample.errors_ratio_interval()
+        self.assertLessEqual(low, 0.01)
+        self.assertGreaterEqual(high, 0.01)
+        exact = {row['url']: row for row in process_logfile(self.log_path, 1000, 0.2)}
+        for row in sample.report_table(3):
+            self.assertLessEqual(row['count_ci'][0], exact[row['url']]['count'])
+            self.assertGreaterEqual(row['count_ci'][1], exact[row['url']]['count'])
+            self.assertLessEqual(row['time_sum_ci'][0], exact[row['url']]['time_sum'])
+            self.assertGreaterEqual(row['time_sum_ci'][1], exact[row['url']]['time_sum'])
+
+    def test_early_abort(self):
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('broken line\n' * 30000)
+        with self.assertRaises(SystemError):
+            check_sample(self.log_path, 0.2)
+
+    def test_early_abort_on_foreign_format(self):
+        # nginx `combined` format, without $request_time at the end
+        with open(self.log_path, 'w') as log_file:
+            log_file.write('1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 12 "-" "Mozilla/5.0 (X)"\n'
+                           * 30000)
+        for parser in ('regex', 'bytes'):
+            with self.assertRaises(SystemError):
+                check_sample(self.log_path, 0.2, parser)
+
+    def test_whole_small_log(self):
+        sample = LogSample(self.log_path)
+        self.assertEqual(sample.coverage, 1)
+        self.assertEqual(sample.estimated_lines, 20000)
+        low, high = sample.errors_ratio_interval()
+        self.assertEqual(low, high)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        with open('report.html', 'w', encoding='utf-8') as template_file:
+            template_file.write('$table_json')
+        os.mkdir('log')
+        os.mkdir('reports')
+        for day in ('20170626', '20170627', '20170703'):
+            write_sample_log('log', 300, f'nginx-access-ui.log-{day}')
+        self.config = dict(DEFAULT_CONFIG, WORKERS=2, ROLLUP='week')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_batch_with_weekly_rollup(self):
+        process_batch(self.config)
+        self.assertEqual(sorted(os.listdir('reports')), [
+            'report-2017.06.26.html', 'report-2017.06.27.html', 'report-2017.07.03.html',
+            'report-2017.W26.html', 'report-2017.W27.html',
+        ])
+        self.assertEqual(len(os.listdir('aggregates')), 3)
+        with open('reports/report-2017.W26.html', encoding='utf-8') as report_file:
+            week_report = report_file.read()
+        with open('log/nginx-access-ui.log-20170626', 'w') as log_file:
+            log_file.write('broken line\n')
+        process_batch(self.config)
+        with open('reports/report-2017.W26.html', encoding='utf-8') as report_file:
+            self.assertEqual(report_file.read(), week_report)
+
+    def test_paged_report(self):
+        process_batch(dict(self.config, ROLLUP=None, REPORT_FORMAT='paged', REPORT_SIZE=20))
+        self.assertIn('report-2017.06.26.jsonl', os.listdir('reports'))
+        with open('reports/report-2017.06.26.html', encoding='utf-8') as report_file:
+            self.assertIn('var ROWS_URL = "report-2017.06.26.jsonl";', report_file.read())
+        with open('reports/report-2017.06.26.jsonl', encoding='utf-8') as rows_file:
+            header, *rows = [json.loads(line) for line in rows_file]
+        self.assertEqual(header['rows'], 20)
+        self.assertEqual(len(rows), 20)
+        self.assertEqual(header['columns'][0], 'url')
+        time_sum = header['columns'].index('time_sum')
+        self.assertEqual(rows, sorted(rows, key=lambda row: row[time_sum], reverse=True))
+
+
+class TestParsers(unittest.TestCase):
+    def test_parity(self):
+        lines = [
+            LOG_LINE.format(url='/api/v2/banner/1', request_time='0.390').encode(),
+            LOG_LINE.format(url='/a', request_time='1').encode(),
+            LOG_LINE.format(url='/', request_time='0.1').encode(),
+            b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+            b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "PROPFIND /dav/ HTTP/1.1" 405 0 0.002\n',
+            b'1.1.1.1 -  - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 12 -\n',
+            b'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET /a HTTP/1.1" 200 12 "-" "Mozilla/5.0 (X)"\n',
+            b'broken line\n',
+            b'',
+        ]
+        regex_parser, bytes_parser = RegexParser(), BytesParser()
+        for line in lines:
+            self.assertEqual(bytes_parser(line), regex_parser(line), line)
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer([
+            ('uuid', r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'),
+            ('id', r'(?<=/)\d+(?=[/?]|$)'),
+        ])
+        self.assertEqual(normalizer.normalize('/api/v2/banner/25019354'), '/api/v2/banner/{id}')
+        self.assertEqual(normalizer.normalize('/api/1/user/0f8fad5b-d9cb-469f-a165-70867728950e/?page=2'),
+                         '/api/{id}/user/{uuid}/?page=2')
+        self.assertEqual(normalizer.normalize('/api/v2/slot/4705/groups'), '/api/v2/slot/{id}/groups')
+
+    def test_parity_on_log(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = write_sample_log(log_dir, 500)
+            regex_parser, bytes_parser, format_parser = RegexParser(), BytesParser(), FormatParser()
+            for line in read_lines(log_path):
+                self.assertEqual(bytes_parser(line), regex_parser(line), line)
+                self.assertEqual(format_parser(line), regex_parser(line), line)
+
+    def test_log_formats(self):
+        combined = FormatParser(
+            '$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent '
+            '"$http_referer" "$http_user_agent" $request_time'
+        )
+        self.assertEqual(combined(
+            b'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET /a?b=1 HTTP/1.1" 200 5 "-" "Mozilla/5.0 (X11)" 0.25\n'
+        ), ('/a?b=1', 0.25))
+        self.assertIsNone(combined(b'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "-" 400 0 "-" "-" 0.000\n'))
+        self.assertIsNone(combined(b'1.1.1.1 - - [29/Jun/2017:03:50:22 +0300] "GET / HTTP/1.1" 200 5 "-" "-" -\n'))
+        edge = FormatParser('[$time_local] ${request_time} $host $request_method "$request_uri" $status')
+        self.assertEqual(edge(b'[29/Jun/2017:03:50:22 +0300] 1.5 example.com GET "/x/y" 200\n'), ('/x/y', 1.5))
+        self.assertIsNone(edge(b'[29/Jun/2017:03:50:22 +0300] 1.5 example.com GET "x" 200\n'))
+        with self.assertRaises(ValueError):
+            FormatParser('$remote_addr "$request"')
+
+    def test_log_format_config(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            config_path = os.path.join(config_dir, 'config.ini')
+            with open(config_path, 'w', encoding='utf-8') as config_file:
+                config_file.write('[DEFAULT]\nLOG_FORMAT: edge\n\n[LOG_FORMATS]\nedge: $request_uri $request_time\n')
+            with mock.patch.object(sys, 'argv', ['log_analyzer.py', f'--config={config_path}']):
+                config = get_config(dict(DEFAULT_CONFIG))
+        self.assertEqual(config['PARSER'], 'format')
+        self.assertEqual(get_parser_options(config), {'log_format': '$request_uri $request_time'})
+        self.assertEqual(create_parser('format', get_parser_options(config))(b'/a 0.5\n'), ('/a', 0.5))
+
+
+class TestMappedLog(unittest.TestCase):
+    def test_byte_ranges(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'access.log')
+            with open(log_path, 'wb') as log_file:
+                log_file.write(b'first line\nsecond\n\nthird line\nunfinished')
+            with MappedLog(log_path) as mapped_log:
+                ranges = mapped_log.split_into_ranges(3)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], mapped_log.size)
+                lines = []
+                for start, end in ranges:
+                    range_lines = list(mapped_log.lines(start, end))
+                    self.assertTrue(all(line.endswith(b'\n') for line in range_lines[:-1]))
+                    lines.extend(range_lines)
+                self.assertEqual(lines, [b'first line\n', b'second\n', b'\n', b'third line\n', b'unfinished'])
+                self.assertEqual(mapped_log.last_line_end(), mapped_log.size - len(b'unfinished'))
+                self.assertEqual(mapped_log.last_line_end(30, mapped_log.size), 30)
+            open(log_path, 'w').close()
+            with MappedLog(log_path) as mapped_log:
+                self.assertEqual(mapped_log.split_into_ranges(3), [])
+                self.assertEqual(list(mapped_log.lines()), [])
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.tmp_dir.name, 'access.log')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def append(self, data: bytes, path: str = None):
+        with open(path or self.log_path, 'ab') as log_file:
+            log_file.write(data)
+
+    def test_tail_returns_complete_lines_only(self):
+        self.append(b'old\n')
+        with LogTail(self.log_path) as tail:
+            self.assertEqual(list(tail.lines()), [])
+            self.append(b'first\nsec')
+            self.assertEqual(list(tail.lines()), [b'first'])
+            self.append(b'ond\n')
+            self.assertEqual(list(tail.lines()), [b'second'])
+
+    def test_tail_follows_rotation(self):
+        self.append(b'')
+        with LogTail(self.log_path) as tail:
+            self.append(b'before\nlast')
+            os.rename(self.log_path, f'{self.log_path}.1')
+            self.assertEqual(list(tail.lines()), [b'before'])
+            self.append(b'new\n')
+            self.assertEqual(list(tail.lines()), [b'last', b'new'])
+            self.append(b'more\n')
+            self.assertEqual(list(tail.lines()), [b'more'])
+
+    def test_tail_rereads_truncated_log(self):
+        self.append(b'long line\n')
+        with LogTail(self.log_path) as tail:
+            with open(self.log_path, 'wb') as log_file:
+                log_file.write(b'new\n')
+            self.assertEqual(list(tail.lines()), [b'new'])
+
+    def test_sliding_windows(self):
+        windows = SlidingWindows()
+        now = 10 * 60 * 60
+        windows.bucket(now - 30 * 60).add('/old', 1.0)
+        windows.bucket(now - 2 * 60).add('/recent', 0.5)
+        recent = windows.bucket(now)
+        recent.add('/recent', 0.1)
+        recent.add_error()
+        snapshot = windows.snapshot(now, 10)['windows']
+        self.assertEqual([row['url'] for row in snapshot['5m']['table']], ['/recent'])
+        self.assertEqual(snapshot['5m']['table'][0]['count'], 2)
+        self.assertEqual((snapshot['15m']['lines'], snapshot['15m']['errors']), (3, 1))
+        self.assertEqual({row['url'] for row in snapshot['60m']['table']}, {'/old', '/recent'})
+        # snapshots do not consume the buckets
+        self.assertEqual(windows.snapshot(now, 10)['windows']['60m']['lines'], 4)
+        # an hour later every bucket is out of the windows, and the ring reuses the old slots
+        later = windows.snapshot(now + 60 * 60, 10)['windows']
+        self.assertEqual(later['60m']['lines'], 0)
+        windows.bucket(now + 60 * 60).add('/next', 0.2)
+        self.assertEqual(len(windows.buckets), 60)
+        self.assertEqual(windows.snapshot(now + 60 * 60, 10)['windows']['60m']['lines'], 1)
+
+    def test_snapshot_leaves_buckets_intact(self):
+        now = 10 * 60 * 60
+        for engine in ('exact', 'sketch', 'topk'):
+            windows = SlidingWindows(engine=engine)
+            windows.bucket(now - 60).add('/a', 0.5)
+            windows.bucket(now).add('/a', 0.1)
+            windows.snapshot(now, 10)
+            windows.bucket(now).add('/a', 0.2)
+            row = windows.snapshot(now, 10)['windows']['5m']['table'][0]
+            self.assertEqual((row['count'], row['time_sum'], row['time_max']), (3, 0.8, 0.5), engine)
+
+
+class TestGenerator(unittest.TestCase):
+    def test_deterministic_log(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = generate_log(os.path.join(log_dir, 'first.log'), 2000, urls_count=20, errors_ratio=0.1, seed=3)
+            gz_path = generate_log(os.path.join(log_dir, 'second.log.gz'), 2000, urls_count=20, errors_ratio=0.1,
+                                   seed=3)
+            with open(log_path, 'rb') as log_file, gzip.open(gz_path, 'rb') as gz_file:
+                self.assertEqual(log_file.read(), gz_file.read())
+            parser = RegexParser()
+            parsed = [parser(line) for line in read_lines(log_path)]
+            self.assertEqual(len(parsed), 2000)
+            self.assertAlmostEqual(parsed.count(None) / len(parsed), 0.1, delta=0.03)
+            self.assertLessEqual(len({url for url, _ in filter(None, parsed)}), 20)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmark(self):
+        results = run_benchmark(500, 20, 'exponential', 0.01, stages=['parse:bytes', 'aggregate:exact'])
+        self.assertEqual(set(results['stages']), {'parse:bytes', 'aggregate:exact'})
+        self.assertEqual(results['stages']['parse:bytes']['items'], 500)
+        baseline = {'stages': {'parse:bytes': {'items_per_sec': results['stages']['parse:bytes']['items_per_sec'] * 2}}}
+        self.assertEqual(len(find_regressions(results, baseline)), 1)
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_relative_error(self):
+        rnd = random.Random(7)
+        values = sorted(rnd.lognormvariate(-2, 1.5) for _ in range(10001))
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        for q in (0.5, 0.95, 0.99):
+            expected = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - expected), expected * QuantileSketch.RELATIVE_ACCURACY)
+
+    def test_merge(self):
+        left, right, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for value in range(1, 1001):
+            (left if value % 2 else right).add(value / 1000)
+            whole.add(value / 1000)
+        left.merge(right)
+        self.assertEqual(left.count, whole.count)
+        self.assertEqual(left.quantile(0.95), whole.quantile(0.95))
+
+
+class TestCountMinSketch(unittest.TestCase):
+    def test_rows_are_independent(self):
+        sketch = CountMinSketch()
+        # collide in row 0, and with seeded crc32 (linear) in every row
+        for first, second in ((b'/api/v2/banner/00000123', b'/api/v2/banner/00000272'),
+                              (b'/api/v2/banner/00001623', b'/api/v2/banner/00008000')):
+            sketch.add(first, 1000)
+            self.assertEqual(sketch.estimate(first), 1000)
+            self.assertEqual(sketch.estimate(second), 0)
+        self.assertEqual(sketch._indexes(b'/api/v2/banner/00000123')[0], sketch._indexes(b'/api/v2/banner/00000272')[0])
+
+    def test_merge(self):
+        left, right = CountMinSketch(), CountMinSketch()
+        left.add(b'/a', 2)
+        right.add(b'/a', 3)
+        self.assertEqual(left.merge(right).estimate(b'/a'), 5)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,13 +1,17 @@
 import json
 import logging
 import hashlib
+import re
+import signal
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from optparse import OptionParser
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from .scoring import get_score, get_interests
-from .store import DBConnector
+from .scoring import get_score, get_interests_many, interests_key, score_key
+from .store import NEGATIVE_TTL, REDIS_MAX_CONNECTIONS, DBConnector, LocalCache, PrefetchedStore
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -33,110 +37,182 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+MAX_BATCH_SIZE = 1000
+DEFAULT_BACKLOG = 128
+KEEPALIVE_TIMEOUT = 5
 
 
 class Field:
+    """Request field.
+
+    check(value) returns (parsed value, None) or (None, error message) without raising,
+    it is what request validation calls; validate(value) raises ValueError instead.
+    """
+
     def __init__(self, required=False, nullable=False):
         self.required = required
         self.nullable = nullable
 
+    def check(self, value):
+        if value is None:
+            if self.required:
+                return None, 'Missed required field'
+            if self.nullable:
+                return None, "Field can't be nullable"
+        return self.parse(value)
+
+    def parse(self, value):
+        return value, None
+
     def validate(self, value):
-        if self.required and value is None:
-            raise ValueError('Missed required field')
-        if self.nullable and value is None:
-            raise ValueError("Field can't be nullable")
+        _, error = self.check(value)
+        if error is not None:
+            raise ValueError(error)
+
+    def type_error(self, value):
+        return None, f'Wrong value type. {self.field_type} expected,  got {type(value)}'
 
 
 class CharField(Field):
     field_type = str
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
+            return self.type_error(value)
+        return value, None
 
 
 class ArgumentsField(Field):
     field_type = dict
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
+            return self.type_error(value)
+        return value, None
 
 
 class EmailField(CharField):
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
+        if not isinstance(value, self.field_type):
+            return self.type_error(value)
         if value and '@' not in value:
-            raise ValueError('Wrong email format')
+            return None, 'Wrong email format'
+        return value, None
 
 
 class PhoneField(Field):
     field_type = str, int
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
+            return self.type_error(value)
         value_str = str(value)
         if len(value_str) != 11 or not value_str.startswith('7'):
-            raise ValueError('Wrong phone number format')
+            return None, 'Wrong phone number format'
         if value:
             try:
                 int(value)
             except ValueError:
-                raise ValueError('Wrong phone number format. Only digests are allowed.')
+                return None, 'Wrong phone number format. Only digests are allowed.'
+        return value, None
 
 
 class DateField(CharField):
+    """Parses the value once, check() returns the datetime."""
     date_format = '%d.%m.%Y'
+    # the usual zero-padded form, parsed without strptime; other forms strptime accepts fall back to it
+    date_pattern = re.compile(r'(\d\d)\.(\d\d)\.(\d{4})', re.ASCII)
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
-        if value:
-            try:
-                datetime.strptime(value, self.date_format)
-            except ValueError:
-                raise ValueError('Wrong date format. DD.MM.YYYY expected')
+            return self.type_error(value)
+        if not value:
+            return value, None
+        match = self.date_pattern.fullmatch(value)
+        try:
+            if match:
+                day, month, year = match.groups()
+                return datetime(int(year), int(month), int(day)), None
+            return datetime.strptime(value, self.date_format), None
+        except ValueError:
+            return None, 'Wrong date format. DD.MM.YYYY expected'
 
 
 class BirthDayField(DateField):
     years_limit = 70
 
-    def validate(self, value):
-        super().validate(value)
-        if value:
-            if (datetime.now() - datetime.strptime(value, self.date_format)) > timedelta(days=365.2 * self.years_limit):
-                raise ValueError(f'Age should be less than {self.years_limit} years')
+    def parse(self, value):
+        date, error = super().parse(value)
+        if date and (datetime.now() - date) > timedelta(days=365.2 * self.years_limit):
+            return None, f'Age should be less than {self.years_limit} years'
+        return date, error
 
 
 class GenderField(Field):
     field_type = int
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
-        if value:
-            if value not in GENDERS:
-                raise ValueError(f'Gender must be an integer within  {list(GENDERS.keys())}')
+            return self.type_error(value)
+        if value and value not in GENDERS:
+            return None, f'Gender must be an integer within  {list(GENDERS.keys())}'
+        return value, None
 
 
 class ClientIDsField(Field):
     field_type = list
 
-    def validate(self, value):
-        super().validate(value)
+    def parse(self, value):
         if not isinstance(value, self.field_type):
-            raise ValueError(f'Wrong value type. {self.field_type} expected,  got {type(value)}')
+            return self.type_error(value)
         if not value:
-            raise ValueError('Client IDs must be a list of integers')
+            return None, 'Client IDs must be a list of integers'
         for client_id in value:
             if not isinstance(client_id, int):
-                raise ValueError('Client ID must be an integer')
+                return None, 'Client ID must be an integer'
+        return value, None
+
+
+def compile_validator(fields):
+    """Builds the function validating a request dict against the fields of a request class.
+
+    It returns (values, parsed values, errors): values of valid fields ('' for empty optional
+    ones) as they are in the request, parsed values (datetime for dates) and error messages.
+    Rules and messages are resolved here, once per class, rather than on every request.
+    """
+    rules = tuple(
+        (
+            field.name,
+            field.required,
+            field.required and not field.nullable,
+            field.check,
+            f'{ERRORS[INVALID_REQUEST]}: {field.name} is not in a query',
+            f'{ERRORS[INVALID_REQUEST]}: {field.name} is null',
+        )
+        for field in fields
+    )
+    error_prefix = f'{ERRORS[INVALID_REQUEST]}: '
+
+    def validator(request):
+        values, parsed, errors = {}, {}, []
+        for name, required, not_null, check, missed_error, null_error in rules:
+            value = request.get(name)
+            if required and name not in request:
+                errors.append(missed_error)
+            elif not_null and not value:
+                errors.append(null_error)
+            elif not required and not value:
+                values[name] = ''
+            else:
+                parsed_value, error = check(value)
+                if error is None:
+                    values[name] = value
+                    parsed[name] = parsed_value
+                else:
+                    errors.append(error_prefix + error)
+        return values, parsed, errors
+
+    return validator
 
 
 class RequestMeta(type):
@@ -150,38 +226,38 @@ class RequestMeta(type):
         new_cls = super(RequestMeta, cls).__new__(cls, name, bases, attrs)
         # new_cls = super().__new__(cls)
         new_cls.fields = fields
+        new_cls.validator = staticmethod(compile_validator(fields))
         return new_cls
 
 
 class Request(metaclass=RequestMeta):
-    context = {}
-    
+
     def __init__(self, request):
         self.request = request
         self.errors = []
+        self.context = {}
+        # parsed values of valid fields, e.g. datetime of date fields
+        self.parsed = {}
 
     def validate(self):
         if not isinstance(self.request, dict):
             self.errors.append(ERRORS[INVALID_REQUEST])
             return False
-        for field in self.fields:
-            value = self.request.get(field.name)
-            if field.required and field.name not in self.request.keys():
-                self.errors.append(f'{ERRORS[INVALID_REQUEST]}: {field.name} is not in a query')
-            elif field.required and not field.nullable and not value:
-                self.errors.append(f'{ERRORS[INVALID_REQUEST]}: {field.name} is null')
-            elif not field.required and not value:
-                setattr(self, field.name, '')
-            else:
-                try:
-                    field.validate(value)
-                    setattr(self, field.name, value)
-                except Exception as e:
-                    self.errors.append(f'{ERRORS[INVALID_REQUEST]}: {e}')
+        values, self.parsed, errors = self.validator(self.request)
+        self.__dict__.update(values)
+        self.errors.extend(errors)
 
     def is_valid(self):
         return not self.errors
 
+    def store_keys(self):
+        """Keys the response reads with store.get, so a batch can fetch them in bulk."""
+        return []
+
+    def cache_keys(self):
+        """Keys the response reads with store.cache_get."""
+        return []
+
 
 class ClientsInterestsRequest(Request):
     client_ids = ClientIDsField(required=True)
@@ -190,11 +266,11 @@ class ClientsInterestsRequest(Request):
     def fill_context(self, ctx):
         self.context['nclients'] = ctx['nclients']
 
+    def store_keys(self):
+        return [interests_key(cid) for cid in self.client_ids]
+
     def response(self, store):
-        resp = {}
-        for cid in self.client_ids:
-            resp[cid] = get_interests(store, cid)
-        return resp
+        return get_interests_many(store, self.client_ids)
 
 
 class OnlineScoreRequest(Request):
@@ -224,11 +300,20 @@ class OnlineScoreRequest(Request):
             self.errors.append(ERRORS[INVALID_REQUEST])
             return False
 
+    @property
+    def birthday_date(self):
+        return self.parsed.get('birthday') or None
+
+    def cache_keys(self):
+        if self.context['is_admin']:
+            return []
+        return [score_key(self.phone, self.birthday_date, self.first_name, self.last_name)]
+
     def response(self, store):
         data = {
             'phone': self.phone,
             'email': self.email,
-            'birthday': self.birthday,
+            'birthday': self.birthday_date,
             'gender': self.gender,
             'first_name': self.first_name,
             'last_name': self.last_name,
@@ -262,12 +347,16 @@ def check_auth(request):
     return False
 
 
-def method_handler(request, ctx, store):
+def build_method_request(body, ctx):
+    """Validates and authenticates a method request.
+
+    Returns (request, OK) for a valid one, (error, code) otherwise.
+    """
     handlers = {
         "online_score": OnlineScoreRequest,
         "clients_interests": ClientsInterestsRequest,
     }
-    method_request = MethodRequest(request['body'])
+    method_request = MethodRequest(body)
     method_request.validate()
     if not method_request.is_valid():
         error = ', '.join(method_request.errors)
@@ -280,26 +369,82 @@ def method_handler(request, ctx, store):
         logging.error(ERRORS[INVALID_REQUEST])
         return ERRORS[INVALID_REQUEST], INVALID_REQUEST
 
+    request_data = handlers[method_request.method](method_request.arguments)
     if method_request.method == 'online_score':
         ctx['is_admin'] = method_request.is_admin
         ctx['has'] = [k for k, v in method_request.arguments.items() if v is not None]
-    elif method_request.method == 'clients_interests':
-        ctx['nclients'] = len(method_request.arguments.get('client_ids', []))
-    request_data = handlers[method_request.method](method_request.arguments)
-    request_data.fill_context(ctx)
+        request_data.fill_context(ctx)
     request_data.validate()
     if request_data.errors or not request_data.is_valid():
         error = ', '.join(request_data.errors)
         logging.error(error)
         return error, INVALID_REQUEST
+    if method_request.method == 'clients_interests':
+        # client_ids can be counted only once it is known to be a list
+        ctx['nclients'] = len(request_data.client_ids)
+        request_data.fill_context(ctx)
+    return request_data, OK
+
+
+def method_handler(request, ctx, store):
+    request_data, code = build_method_request(request['body'], ctx)
+    if code != OK:
+        return request_data, code
     response = request_data.response(store)
     logging.info("Success request")
     return response, OK
 
 
+def batch_handler(request, ctx, store):
+    """Serves an array of method requests in one round trip.
+
+    Every item is validated and authenticated on its own; store keys of all valid items
+    are fetched in bulk before any item is answered. Returns a list of per-item
+    {"response": ..., "code": ...} or {"error": ..., "code": ...} results.
+    """
+    body = request['body']
+    if not isinstance(body, list) or not body:
+        return f'{ERRORS[INVALID_REQUEST]}: a non-empty array of method requests expected', INVALID_REQUEST
+    if len(body) > MAX_BATCH_SIZE:
+        return f'{ERRORS[INVALID_REQUEST]}: at most {MAX_BATCH_SIZE} requests per batch', INVALID_REQUEST
+    items = []
+    for item in body:
+        # a broken item gets its own error result instead of failing the whole batch
+        try:
+            items.append(build_method_request(item, dict(ctx)))
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            items.append((None, INTERNAL_ERROR))
+    valid_requests = [request_data for request_data, code in items if code == OK]
+    results = []
+    # with pipelined writes the cache write-backs of the whole batch take one Redis round trip
+    with store.write_back():
+        prefetched_store = PrefetchedStore(
+            store,
+            store.get_many([key for request_data in valid_requests for key in request_data.store_keys()]),
+            # missing scores are calculated and cached below, negative markers would only be overwritten
+            store.cache_get_many([key for request_data in valid_requests for key in request_data.cache_keys()],
+                                 negative=False),
+        )
+        for request_data, code in items:
+            if code == OK:
+                try:
+                    request_data, code = request_data.response(prefetched_store), OK
+                except Exception as e:
+                    logging.exception("Unexpected error: %s" % e)
+                    request_data, code = None, INTERNAL_ERROR
+            if code not in ERRORS:
+                results.append({"response": request_data, "code": code})
+            else:
+                results.append({"error": request_data or ERRORS[code], "code": code})
+    logging.info("Success batch of %s requests" % len(items))
+    return results, OK
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
     store = DBConnector()
 
@@ -316,6 +461,8 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
         except Exception as e:
             logging.error(e)
             code = BAD_REQUEST
+            # the body may be left unread, so the connection can not be reused
+            self.close_connection = True
 
         if request:
             path = self.path.strip("/")
@@ -329,30 +476,135 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
         if code not in ERRORS:
             r = {"response": response, "code": code}
         else:
             r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r).encode('utf-8'))
+        self.send_json(code, r)
         return
 
+    def do_GET(self):
+        # store counters (local cache hits, misses, evictions) for sizing
+        if self.path.strip("/") == "stats":
+            self.send_json(OK, {"response": self.store.stats(), "code": OK})
+        else:
+            self.send_json(NOT_FOUND, {"error": ERRORS[NOT_FOUND], "code": NOT_FOUND})
+
+    def send_json(self, code, r):
+        body = json.dumps(r).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer handling connections in a bounded pool of worker threads.
+
+    While all workers are busy, new connections are not accepted and wait
+    in the listen backlog (request_queue_size).
+    """
+
+    def __init__(self, server_address, handler_class, workers, bind_and_activate=True):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-worker')
+        self.slots = threading.BoundedSemaphore(workers)
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def create_server(address, workers=0, backlog=DEFAULT_BACKLOG, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                  handler_class=MainHTTPHandler):
+    """Without workers requests are served one at a time over HTTP/1.0, as before.
+    With workers connections are served concurrently and kept alive (HTTP/1.1)
+    until idle for keepalive_timeout seconds.
+    """
+    if workers:
+        handler_class = type(handler_class.__name__, (handler_class,), {
+            'protocol_version': 'HTTP/1.1',
+            'timeout': keepalive_timeout,
+            # headers and body are separate writes, with Nagle's algorithm the body of a kept-alive
+            # response would wait for the client's delayed ACK
+            'disable_nagle_algorithm': True,
+        })
+        server = PooledHTTPServer(address, handler_class, workers, bind_and_activate=False)
+    else:
+        server = HTTPServer(address, handler_class, bind_and_activate=False)
+    server.request_queue_size = backlog
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+    return server
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=0,
+                  help="serve connections in a pool of N threads with HTTP/1.1 keep-alive")
+    op.add_option("-b", "--backlog", action="store", type=int, default=DEFAULT_BACKLOG)
+    op.add_option("--keepalive-timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT)
+    op.add_option("--local-cache-entries", action="store", type=int, default=0,
+                  help="keep up to N cached values in process in front of Redis, 0 disables it")
+    op.add_option("--local-cache-mb", action="store", type=int, default=16)
+    op.add_option("--local-cache-ttl", action="store", type=int, default=60,
+                  help="seconds to keep values read from Redis in the local cache")
+    op.add_option("--early-refresh-beta", action="store", type=float, default=0,
+                  help="refresh cached scores before they expire (XFetch), 1 is the usual value, 0 disables it")
+    op.add_option("--negative-ttl", action="store", type=int, default=NEGATIVE_TTL,
+                  help="seconds to remember keys missing in Redis and Mongo, 0 disables it")
+    op.add_option("--redis-max-connections", action="store", type=int, default=REDIS_MAX_CONNECTIONS,
+                  help="Redis connection pool size, keep it at least --workers")
+    op.add_option("--pipeline-writes", action="store_true", default=False,
+                  help="send the cache writes of a batch request to Redis in one pipeline")
+    op.add_option("--write-behind", action="store", type=int, default=0,
+                  help="write the cache to Redis from a background thread, queueing up to N writes")
     (opts, args) = op.parse_args()
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    local_cache = None
+    if opts.local_cache_entries:
+        local_cache = LocalCache(opts.local_cache_entries, opts.local_cache_mb * 1024 * 1024, opts.local_cache_ttl)
+    MainHTTPHandler.store = DBConnector(local_cache, opts.early_refresh_beta, opts.negative_ttl,
+                                        max(opts.redis_max_connections, opts.workers), opts.pipeline_writes,
+                                        opts.write_behind)
+    server = create_server(("localhost", opts.port), opts.workers, opts.backlog, opts.keepalive_timeout)
     logging.info("Starting server at %s" % opts.port)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever to return, so it can not be called from the main thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    MainHTTPHandler.store.close()
@@ -0,0 +1,138 @@
+"""Load test of the scoring API: RPS and latency percentiles under concurrent clients.
+
+    python -m scoring_api.load_test                   # single-threaded vs pooled server, in-process
+    python -m scoring_api.load_test --url http://localhost:8080/method
+
+In the comparison mode the servers use a stand-in store that sleeps --latency seconds
+per call instead of querying Redis/Mongo, so the numbers show how a slow backend call
+affects other clients rather than the speed of a particular database.
+"""
+import hashlib
+import http.client
+import json
+import threading
+import time
+from optparse import OptionParser
+from urllib.parse import urlsplit
+
+from . import api
+
+
+class SlowStore:
+    """Store with a fixed latency per call and no data."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get(self, key):
+        time.sleep(self.latency)
+        return None
+
+    def get_many(self, keys):
+        time.sleep(self.latency)
+        return {}
+
+    def cache_get_or_set(self, key, compute, expire_after=3600):
+        time.sleep(self.latency)
+        return compute()
+
+
+def make_body(client_ids=(1, 2, 3)):
+    account, login = 'horns&hoofs', 'h&f'
+    return json.dumps({
+        'account': account,
+        'login': login,
+        'method': 'clients_interests',
+        'token': hashlib.sha512((account + login + api.SALT).encode('utf-8')).hexdigest(),
+        'arguments': {'client_ids': list(client_ids)},
+    }).encode('utf-8')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def run_clients(url, clients, requests):
+    """Sends `requests` POSTs from `clients` threads, each reusing its connection where the server allows."""
+    parts = urlsplit(url)
+    body = make_body()
+    latencies, errors = [], []
+    lock = threading.Lock()
+    per_client = [requests // clients + (number < requests % clients) for number in range(clients)]
+
+    def client(count):
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        own_latencies, own_errors = [], 0
+        for _ in range(count):
+            started_at = time.perf_counter()
+            try:
+                connection.request('POST', parts.path, body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                if response.status != api.OK:
+                    own_errors += 1
+            except (OSError, http.client.HTTPException):
+                own_errors += 1
+                connection.close()
+            own_latencies.append(time.perf_counter() - started_at)
+        connection.close()
+        with lock:
+            latencies.extend(own_latencies)
+            errors.append(own_errors)
+
+    threads = [threading.Thread(target=client, args=(count,)) for count in per_client]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'rps': round(len(latencies) / elapsed),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def run_server(workers, latency, clients, requests, backlog):
+    handler_class = type('LoadTestHandler', (api.MainHTTPHandler,), {
+        'store': SlowStore(latency),
+        'log_message': lambda self, format, *args: None,
+    })
+    server = api.create_server(('localhost', 0), workers, backlog, handler_class=handler_class)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        return run_clients(f'http://localhost:{server.server_address[1]}/method', clients, requests)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main():
+    op = OptionParser()
+    op.add_option("--url", action="store", default=None, help="test a running server instead of comparing")
+    op.add_option("-c", "--clients", action="store", type=int, default=32)
+    op.add_option("-n", "--requests", action="store", type=int, default=2000)
+    op.add_option("-w", "--workers", action="store", type=int, default=32, help="pool size of the pooled server")
+    op.add_option("--latency", action="store", type=float, default=0.005, help="seconds per store call")
+    op.add_option("-b", "--backlog", action="store", type=int, default=api.DEFAULT_BACKLOG)
+    (opts, args) = op.parse_args()
+    if opts.url:
+        results = {opts.url: run_clients(opts.url, opts.clients, opts.requests)}
+    else:
+        results = {
+            'single-threaded': run_server(0, opts.latency, opts.clients, opts.requests, opts.backlog),
+            f'pooled, {opts.workers} workers': run_server(opts.workers, opts.latency, opts.clients, opts.requests,
+                                                          opts.backlog),
+        }
+    for name, result in results.items():
+        print(f"{name:<24} {result['rps']:>7} rps  p50 {result['p50_ms']:>7} ms  p99 {result['p99_ms']:>7} ms  "
+              f"{result['errors']} errors of {result['requests']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Round trips to Redis: one-by-one commands vs pipelines, and connection pool sizes.
+
+    python -m scoring_api.redis_bench                 # against an in-process Redis stand-in
+    python -m scoring_api.redis_bench --port 6379     # against a running Redis
+
+The stand-in speaks enough of the Redis protocol (GET, SET, MGET, PTTL) for RedisConnector
+and waits --latency seconds per round trip, i.e. once per batch of commands read from the
+socket, so the numbers show how many round trips a call takes rather than the speed of Redis.
+"""
+import socketserver
+import threading
+import time
+from optparse import OptionParser
+
+from . import store
+
+
+def parse_commands(buffer):
+    """Splits complete RESP arrays off the buffer; returns (commands, rest of the buffer)."""
+    commands, position = [], 0
+    while True:
+        end = buffer.find(b'\r\n', position)
+        if end < 0:
+            return commands, buffer[position:]
+        cursor, args = end + 2, []
+        for _ in range(int(buffer[position + 1:end])):
+            end = buffer.find(b'\r\n', cursor)
+            if end < 0:
+                return commands, buffer[position:]
+            start = end + 2
+            cursor = start + int(buffer[cursor + 1:end]) + 2
+            if cursor > len(buffer):
+                return commands, buffer[position:]
+            args.append(buffer[start:cursor - 2])
+        commands.append(args)
+        position = cursor
+
+
+def encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class StandInRedis(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency):
+        super().__init__(address, StandInRedisHandler)
+        self.latency = latency
+        # {key: (value, expires at)}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.round_trips = 0
+
+    def get(self, key):
+        value, expires_at = self.values.get(key, (None, None))
+        if expires_at is not None and expires_at < time.monotonic():
+            return None, None
+        return value, expires_at
+
+    def execute(self, command, *args):
+        command = command.upper()
+        with self.lock:
+            if command == b'GET':
+                return self.get(args[0])[0]
+            if command == b'MGET':
+                return [self.get(key)[0] for key in args]
+            if command == b'SET':
+                expire_after = int(args[3]) if len(args) > 3 and args[2].upper() == b'EX' else None
+                self.values[args[0]] = (args[1], time.monotonic() + expire_after if expire_after else None)
+                return b'+OK\r\n'
+            if command == b'PTTL':
+                value, expires_at = self.get(args[0])
+                if value is None:
+                    return -2
+                return int((expires_at - time.monotonic()) * 1000) if expires_at else -1
+        if command == b'HELLO':
+            # protocol handshake redis-py starts with, answered with the requested version
+            return b'%%1\r\n$5\r\nproto\r\n:%s\r\n' % (args[0] if args else b'2')
+        # CLIENT SETINFO and the like sent on connect
+        return b'+OK\r\n'
+
+
+class StandInRedisHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        buffer = b''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            commands, buffer = parse_commands(buffer + data)
+            if not commands:
+                continue
+            time.sleep(self.server.latency)
+            self.server.round_trips += 1
+            replies = []
+            for command in commands:
+                reply = self.server.execute(*command)
+                replies.append(reply if isinstance(reply, bytes) and reply[:1] in (b'+', b'%') else encode(reply))
+            self.request.sendall(b''.join(replies))
+
+
+def timed(function):
+    started_at = time.perf_counter()
+    function()
+    return time.perf_counter() - started_at
+
+
+def run(port, keys, threads, pool_sizes, round_trips=lambda: 0):
+    results = {}
+    redis_storage = store.RedisConnector(dict(store.REDIS_CONFIG, port=port))
+    values = {f'uid:{number}': str(number) for number in range(keys)}
+
+    def measure(name, function):
+        count = round_trips()
+        results[name] = (timed(function), round_trips() - count)
+
+    measure(f'{keys} SET one by one', lambda: [redis_storage.set(key, value, 60) for key, value in values.items()])
+    measure(f'{keys} SET in a pipeline',
+            lambda: redis_storage.execute_many([('set', key, value, 60) for key, value in values.items()]))
+    measure(f'{keys} GET one by one', lambda: [redis_storage.get(key) for key in values])
+    measure(f'{keys} GET as one MGET', lambda: redis_storage.get_many(list(values)))
+
+    for pool_size in pool_sizes:
+        pooled_storage = store.RedisConnector(dict(store.REDIS_CONFIG, port=port), pool_size)
+
+        def client():
+            for key in list(values)[:keys // threads or 1]:
+                pooled_storage.get(key)
+
+        def clients():
+            workers = [threading.Thread(target=client) for _ in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        # connections are opened on demand, so the first run only fills the pool
+        clients()
+        measure(f'{threads} threads GET, pool of {pool_size}', clients)
+        pooled_storage.storage.close()
+    return results
+
+
+def main():
+    op = OptionParser()
+    op.add_option("--port", action="store", type=int, default=0, help="a running Redis instead of the stand-in")
+    op.add_option("-n", "--keys", action="store", type=int, default=500)
+    op.add_option("-c", "--threads", action="store", type=int, default=32)
+    op.add_option("--latency", action="store", type=float, default=0.0002, help="stand-in seconds per round trip")
+    (opts, args) = op.parse_args()
+    pool_sizes = (4, opts.threads)
+    if opts.port:
+        results = run(opts.port, opts.keys, opts.threads, pool_sizes)
+    else:
+        server = StandInRedis(('localhost', 0), opts.latency)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            results = run(server.server_address[1], opts.keys, opts.threads, pool_sizes, lambda: server.round_trips)
+        finally:
+            server.shutdown()
+            server.server_close()
+    for name, (elapsed, round_trips) in results.items():
+        print(f"{name:<32} {elapsed * 1000:>9.1f} ms  {round_trips or '-':>5} round trips")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,31 @@ import hashlib
 import json
 
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+def score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
-        phone or "",
-        birthday.strftime("%Y%m%d") if birthday is not None else "",
+        str(phone or ""),
+        birthday.strftime("%Y%m%d") if birthday else "",
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
+
+
+def interests_key(cid):
+    return "i:%s" % cid
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = score_key(phone, birthday, first_name, last_name)
+    # try get from cache, fallback to heavy calculation in case of cache miss;
+    # concurrent misses of one key are calculated once, the result is cached for 60 minutes
+    return store.cache_get_or_set(
+        key, lambda: calculate_score(phone, email, birthday, gender, first_name, last_name), 60 * 60
+    )
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,11 +35,16 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
     return score
 
 
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
+    r = store.get(interests_key(cid))
     return json.loads(r) if r else []
+
+
+def get_interests_many(store, cids):
+    """Interests of every client id, fetched with one store.get_many call."""
+    keys = {cid: interests_key(cid) for cid in cids}
+    values = store.get_many(list(keys.values()))
+    return {cid: json.loads(values[key]) if values.get(key) else [] for cid, key in keys.items()}
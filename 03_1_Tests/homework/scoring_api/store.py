@@ -1,9 +1,16 @@
 import logging
+import math
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from pymongo import MongoClient
-from redis import Redis
+from redis import BlockingConnectionPool, Redis
 from redis.backoff import ExponentialBackoff
-from redis.exceptions import TimeoutError
+from redis.exceptions import RedisError, TimeoutError
 from redis.retry import Retry
 
 
@@ -15,6 +22,9 @@ MONGODB_CONFIG = {
 }
 MONGODB_DB = 'Otus'
 MONGODB_COLLECTION = 'scoring_api'
+# stored in the cache for keys missing in both Redis and Mongo
+NEGATIVE_VALUE = '\x00missing'
+NEGATIVE_TTL = 30
 REDIS_CONFIG = {
             'decode_responses': True,
             'socket_timeout': 2,
@@ -22,6 +32,9 @@ REDIS_CONFIG = {
             'retry_on_timeout': True,
             'retry': Retry(ExponentialBackoff(), 3)
 }
+# connections a RedisConnector keeps open, a thread waits up to REDIS_POOL_TIMEOUT seconds for a free one
+REDIS_MAX_CONNECTIONS = 32
+REDIS_POOL_TIMEOUT = 2
 
 
 class MongoConnector:
@@ -32,10 +45,21 @@ class MongoConnector:
         result = self.storage.find_one({'_id': key})
         return result.get('value') if result else None
 
+    def get_many(self, keys):
+        """Fetches all keys with a single $in query; missing keys are left out."""
+        if not keys:
+            return {}
+        return {
+            document['_id']: document.get('value')
+            for document in self.storage.find({'_id': {'$in': list(keys)}}, {'value': 1})
+        }
+
 
 class RedisConnector:
-    def __init__(self, config):
-        self.storage = Redis(**config)
+    def __init__(self, config, max_connections=REDIS_MAX_CONNECTIONS):
+        self.storage = Redis(connection_pool=BlockingConnectionPool(
+            max_connections=max_connections, timeout=REDIS_POOL_TIMEOUT, **config
+        ))
 
     def get(self, key):
         try:
@@ -44,6 +68,40 @@ class RedisConnector:
             logging.error('Redis connection timeout')
             return None
 
+    def get_many(self, keys):
+        """Fetches all keys with a single MGET; missing keys are left out."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            values = self.storage.mget(keys)
+        except TimeoutError:
+            logging.error('Redis connection timeout')
+            return {}
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def get_with_ttl(self, key):
+        """Returns (value, seconds to expiry) read in one round trip; ttl is None for a missing key."""
+        value, ttl = self.execute_many([('get', key), ('pttl', key)])
+        return value, ttl / 1000 if ttl is not None and ttl >= 0 else None
+
+    def execute_many(self, commands, raise_errors=False):
+        """Sends [(command, *args), ...] in one pipelined round trip; returns their results in order.
+
+        The pipeline is not a transaction, so other clients' commands may run in between.
+        A timeout is logged and gives None results unless raise_errors is set.
+        """
+        try:
+            pipeline = self.storage.pipeline(transaction=False)
+            for command, *args in commands:
+                getattr(pipeline, command)(*args)
+            return pipeline.execute()
+        except TimeoutError:
+            logging.error('Redis connection timeout')
+            if raise_errors:
+                raise
+            return [None] * len(commands)
+
     def set(self, key, value, expire_after=3600):
         try:
             self.storage.set(key, value, expire_after)
@@ -51,19 +109,341 @@ class RedisConnector:
             logging.error('Redis connection timeout')
 
 
+class LocalCache:
+    """In-process LRU cache with per-entry TTL, bounded by entry count and (approximate) byte size.
+
+    Values read from Redis have an unknown remaining TTL, so they are kept for at most
+    `default_ttl` seconds; values written with cache_set live for their `expire_after`.
+    Safe to share between server threads.
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, default_ttl=60, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.clock = clock
+        # key -> (value, expires_at, size), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """Returns (value, seconds to expiry), (None, None) for a missing or expired key."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, None
+            ttl = entry[1] - self.clock()
+            if ttl <= 0:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], ttl
+
+    def set(self, key, value, expire_after=None):
+        ttl = self.default_ttl if expire_after is None else expire_after
+        size = sys.getsizeof(key) + sys.getsizeof(value)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, self.clock() + ttl, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class SingleFlight:
+    """Runs one call per key at a time: callers that ask for a key already in flight
+    wait for that call and share its result (or its exception).
+
+    Results are also kept for `linger` seconds after a call finishes, so a caller that
+    missed the key before the call finished (do's `since`) gets its result too instead
+    of starting the same call again.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, linger=1, clock=time.monotonic):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.linger = linger
+        self.clock = clock
+        # {key: (finished at, result)} of recent successful calls, oldest first
+        self.finished = OrderedDict()
+
+    def do(self, key, function, since=None):
+        with self.lock:
+            now = self.clock()
+            while self.finished and next(iter(self.finished.values()))[0] < now - self.linger:
+                self.finished.popitem(last=False)
+            if since is not None and key in self.finished and self.finished[key][0] >= since:
+                return self.finished[key][1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call.error is None:
+                    self.finished.pop(key, None)
+                    self.finished[key] = (self.clock(), call.result)
+            call.done.set()
+
+
+class WriteBehindQueue:
+    """Sends Redis writes from a background thread, so callers do not wait for Redis.
+
+    Writes are buffered by key (a newer write of a key replaces a queued one) and sent in
+    pipelines of up to `batch_size` commands. When `max_size` writes are queued the oldest
+    one is dropped: it is only a cache write, the value is recalculated or read from Mongo
+    on the next miss. close() sends everything still queued.
+    """
+
+    def __init__(self, redis_storage, max_size=10000, batch_size=500):
+        self.redis_storage = redis_storage
+        self.max_size = max_size
+        self.batch_size = batch_size
+        # {key: (value, expire_after)} in the order of writing
+        self.queue = OrderedDict()
+        # the batch being sent, still readable with get()
+        self.sending = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.written = self.dropped = self.failed = self.batches = 0
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def put(self, key, value, expire_after):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('write-behind queue is closed')
+            self.queue.pop(key, None)
+            self.queue[key] = (value, expire_after)
+            if len(self.queue) > self.max_size:
+                self.queue.popitem(last=False)
+                self.dropped += 1
+            self.condition.notify()
+
+    def get(self, key):
+        """Returns the queued (value, expire_after) of the key, None if nothing is queued for it."""
+        with self.condition:
+            return self.queue.get(key) or self.sending.get(key)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                while self.queue and len(self.sending) < self.batch_size:
+                    key, write = self.queue.popitem(last=False)
+                    self.sending[key] = write
+                batch = list(self.sending.items())
+            try:
+                self.redis_storage.execute_many([
+                    ('set', key, value, expire_after) for key, (value, expire_after) in batch
+                ], raise_errors=True)
+                written, failed = len(batch), 0
+            except Exception as e:
+                logging.error('Redis write-behind failed: %s' % e)
+                written, failed = 0, len(batch)
+            with self.condition:
+                self.sending = {}
+                self.written += written
+                self.failed += failed
+                self.batches += 1
+
+    def close(self, timeout=None):
+        """Stops accepting writes and waits until the queued ones are sent."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': len(self.queue),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
+
+
 class DBConnector:
-    def __init__(self):
+    def __init__(self, local_cache=None, early_refresh_beta=0, negative_ttl=NEGATIVE_TTL,
+                 redis_max_connections=REDIS_MAX_CONNECTIONS, pipeline_writes=False, write_behind_size=0):
         self.mongodb_storage = MongoConnector(MONGODB_CONFIG)
-        self.redis_storage = RedisConnector(REDIS_CONFIG)
+        self.redis_storage = RedisConnector(REDIS_CONFIG, redis_max_connections)
+        # optional in-process tier in front of Redis
+        self.local_cache = local_cache
+        self.single_flight = SingleFlight()
+        # 0 disables probabilistic early refresh, 1 is the usual XFetch setting, more refreshes earlier
+        self.early_refresh_beta = early_refresh_beta
+        # moving average of how long cache_fill takes, the XFetch "delta"
+        self.fill_seconds = 0
+        # seconds to remember keys missing in both Redis and Mongo, 0 disables negative caching
+        self.negative_ttl = negative_ttl
+        self.counters_lock = threading.Lock()
+        self.negative_hits = self.negative_sets = 0
+        # Redis writes of write_back blocks send in one pipeline, per thread
+        self.pipeline_writes = pipeline_writes
+        self.pending = threading.local()
+        # optional background writer, the request thread then only queues Redis writes
+        self.write_behind = WriteBehindQueue(self.redis_storage, write_behind_size) if write_behind_size else None
 
     def get(self, key):
-        self.mongodb_storage.get(key)
+        """Reads the key from Mongo, unless a negative marker says it is missing there."""
+        if self._known_missing([key]):
+            return None
+        value = self.mongodb_storage.get(key)
+        if value is None:
+            self._remember_missing([key])
+        return value
+
+    def get_many(self, keys):
+        """Returns {key: value} for the given keys, None for missing ones, in one Mongo round trip.
+
+        Keys with a negative marker are left out of the query; markers of keys the query
+        misses are written in one pipeline.
+        """
+        known_missing = self._known_missing(keys)
+        values = self.mongodb_storage.get_many([key for key in keys if key not in known_missing])
+        self._remember_missing([key for key in keys if key not in values and key not in known_missing])
+        return {key: values.get(key) for key in keys}
+
+    def _known_missing(self, keys):
+        """Keys with a negative marker in the local cache or Redis, looked up with one MGET at most.
+
+        Reads of Mongo do not depend on Redis otherwise, so a Redis error means no markers.
+        """
+        if not self.negative_ttl:
+            return set()
+        markers, redis_keys = set(), []
+        for key in keys:
+            if self.local_cache is not None and self.local_cache.get(key) == NEGATIVE_VALUE:
+                markers.add(key)
+            else:
+                redis_keys.append(key)
+        try:
+            redis_values = self.redis_storage.get_many(redis_keys)
+        except RedisError as e:
+            logging.error('Redis negative markers lookup failed: %s' % e)
+            redis_values = {}
+        markers.update(key for key, value in redis_values.items() if value == NEGATIVE_VALUE)
+        for _ in markers:
+            self._negative_hit()
+        return markers
+
+    def _remember_missing(self, keys):
+        """Writes negative markers of keys Mongo missed, in one pipeline."""
+        if not self.negative_ttl or not keys:
+            return
+        try:
+            with self.write_back(pipelined=True):
+                for key in keys:
+                    self.cache_set_negative(key)
+        except RedisError as e:
+            logging.error('Redis negative markers write failed: %s' % e)
+
+    @contextmanager
+    def write_back(self, pipelined=None):
+        """Collects Redis writes of the block and sends them in one pipeline when it ends.
+
+        Does nothing unless pipelined (pipeline_writes by default) is set or a block is already
+        open in the thread. Until the block ends other threads see the values in the local cache only.
+        """
+        if getattr(self.pending, 'writes', None) is not None or not (
+                self.pipeline_writes if pipelined is None else pipelined):
+            yield
+            return
+        # {key: (value, expire_after)}, the last write of a key wins
+        self.pending.writes = {}
+        try:
+            yield
+        finally:
+            writes, self.pending.writes = self.pending.writes, None
+            if writes:
+                self.redis_storage.execute_many([
+                    ('set', key, value, expire_after) for key, (value, expire_after) in writes.items()
+                ])
+
+    def _redis_set(self, key, value, expire_after):
+        writes = getattr(self.pending, 'writes', None)
+        if self.write_behind is not None:
+            self.write_behind.put(key, value, expire_after)
+        elif writes is not None:
+            writes[key] = (value, expire_after)
+        else:
+            self.redis_storage.set(key, value, expire_after)
 
     def cache_set(self, key, value, expire_after=3600):
-        self.redis_storage.set(key, value, expire_after)
+        self._redis_set(key, value, expire_after)
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, expire_after)
+
+    def cache_set_negative(self, key):
+        """Remembers for negative_ttl seconds that the key exists neither in Redis nor in Mongo."""
+        if not self.negative_ttl:
+            return
+        self._redis_set(key, NEGATIVE_VALUE, self.negative_ttl)
+        if self.local_cache is not None:
+            self.local_cache.set(key, NEGATIVE_VALUE, self.negative_ttl)
+        with self.counters_lock:
+            self.negative_sets += 1
+
+    def _negative_hit(self):
+        with self.counters_lock:
+            self.negative_hits += 1
 
     def cache_get(self, key):
-        result = self.redis_storage.get(key)
+        result, _ = self._cached(key)
+        if result == NEGATIVE_VALUE:
+            self._negative_hit()
+            return None
         if result:
             return result
         else:
@@ -73,3 +453,161 @@ class DBConnector:
                 # storing value in buffer database (Redis)
                 self.cache_set(key, mongo_result)
                 return mongo_result
+            self.cache_set_negative(key)
+
+    def cache_get_many(self, keys, negative=True):
+        """Returns {key: value} like cache_get for every key, None for missing ones.
+
+        Takes one Redis MGET plus, for keys Redis misses, one Mongo $in query and
+        one pipeline writing what it found (or did not find) back to Redis. Callers that
+        compute and cache the missing values themselves pass negative=False, so no
+        negative markers are written for them just to be overwritten.
+        """
+        values = {}
+        if self.local_cache is not None:
+            for key in keys:
+                value = self.local_cache.get(key)
+                if value:
+                    values[key] = value
+        redis_keys = [key for key in keys if key not in values]
+        if redis_keys:
+            redis_values = self.redis_storage.get_many(redis_keys)
+            if self.local_cache is not None:
+                for key, value in redis_values.items():
+                    self.local_cache.set(key, value)
+            values.update(redis_values)
+        for key, value in values.items():
+            if value == NEGATIVE_VALUE:
+                self._negative_hit()
+        missed_keys = [key for key in keys if not values.get(key)]
+        if missed_keys:
+            mongo_values = self.mongodb_storage.get_many(missed_keys)
+            with self.write_back(pipelined=True):
+                for key in missed_keys:
+                    mongo_result = mongo_values.get(key)
+                    if mongo_result:
+                        self.cache_set(key, mongo_result)
+                        values[key] = mongo_result
+                    elif negative:
+                        self.cache_set_negative(key)
+        return {key: values[key] if values.get(key) and values[key] != NEGATIVE_VALUE else None for key in keys}
+
+    def _cached(self, key):
+        """Looks the key up in the local cache and Redis only; returns (value, seconds to expiry or None)."""
+        writes = getattr(self.pending, 'writes', None)
+        if writes and key in writes:
+            # written in the thread's write_back block, not sent yet
+            return writes[key]
+        if self.write_behind is not None:
+            queued = self.write_behind.get(key)
+            if queued:
+                return queued
+        if self.local_cache is not None:
+            value, ttl = self.local_cache.get_with_ttl(key)
+            if value:
+                return value, ttl
+        if self.early_refresh_beta:
+            value, ttl = self.redis_storage.get_with_ttl(key)
+        else:
+            value, ttl = self.redis_storage.get(key), None
+        if value and self.local_cache is not None:
+            self.local_cache.set(key, value, min(ttl, self.local_cache.default_ttl) if ttl else None)
+        return value, ttl
+
+    def _refresh_early(self, ttl):
+        """XFetch: refresh with a probability that grows as the expiry gets closer than the fill time."""
+        if not self.early_refresh_beta or ttl is None or not self.fill_seconds:
+            return False
+        return -self.fill_seconds * self.early_refresh_beta * math.log(1 - random.random()) >= ttl
+
+    def cache_get_or_set(self, key, compute, expire_after=3600):
+        """Returns the cached value of the key, filling the cache with cache_fill on a miss.
+
+        Concurrent misses of one key are coalesced, so only one caller reads Mongo, computes
+        and writes the value while the others wait for it. With early_refresh_beta set, a
+        cached value may also be refreshed shortly before it expires, by one caller at a time;
+        other callers keep getting the cached value meanwhile.
+        """
+        # a flight of the key finishing after this moment already has a fresh value
+        since = self.single_flight.clock()
+        value, ttl = self._cached(key)
+        negative = value == NEGATIVE_VALUE
+        if negative:
+            # known to be missing in Mongo, only the calculation is left
+            self._negative_hit()
+        elif value and not self._refresh_early(ttl):
+            return value
+        return self.single_flight.do(
+            key, lambda: self.cache_fill(key, compute, expire_after, skip_mongo=negative), since=since
+        )
+
+    def cache_fill(self, key, compute, expire_after=3600, skip_mongo=False):
+        """Reads the key from Mongo (unless skip_mongo) or computes it, and caches the value."""
+        started_at = time.perf_counter()
+        value = None
+        if not skip_mongo:
+            value = self.mongodb_storage.get(key)
+            if value:
+                self.cache_set(key, value)
+        if not value:
+            value = compute()
+            self.cache_set(key, value, expire_after)
+        self.fill_seconds = 0.9 * self.fill_seconds + 0.1 * (time.perf_counter() - started_at)
+        return value
+
+    def stats(self):
+        with self.counters_lock:
+            stats = {'negative_cache': {'hits': self.negative_hits, 'sets': self.negative_sets}}
+        if self.local_cache is not None:
+            stats['local_cache'] = self.local_cache.stats()
+        if self.write_behind is not None:
+            stats['write_behind'] = self.write_behind.stats()
+        return stats
+
+    def close(self):
+        """Sends the writes still queued for Redis, to be called on shutdown."""
+        if self.write_behind is not None:
+            self.write_behind.close()
+
+
+class PrefetchedStore:
+    """Store view answering reads from values fetched in bulk beforehand.
+
+    Keys that were not prefetched are read from the store; writes go through to it.
+    """
+
+    def __init__(self, store, values, cached_values):
+        self.store = store
+        self.values = values
+        self.cached_values = cached_values
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        missed_keys = [key for key in keys if key not in self.values]
+        values = self.store.get_many(missed_keys) if missed_keys else {}
+        return {key: self.values[key] if key in self.values else values.get(key) for key in keys}
+
+    def write_back(self, pipelined=None):
+        return self.store.write_back(pipelined)
+
+    def cache_get(self, key):
+        if key in self.cached_values:
+            return self.cached_values[key]
+        return self.store.cache_get(key)
+
+    def cache_set(self, key, value, expire_after=3600):
+        self.store.cache_set(key, value, expire_after)
+        self.cached_values[key] = value
+
+    def cache_get_or_set(self, key, compute, expire_after=3600):
+        if key in self.cached_values:
+            # the prefetch already looked in the cache and Mongo, a miss only needs computing
+            if not self.cached_values[key]:
+                self.cache_set(key, compute(), expire_after)
+            return self.cached_values[key]
+        self.cached_values[key] = self.store.cache_get_or_set(key, compute, expire_after)
+        return self.cached_values[key]
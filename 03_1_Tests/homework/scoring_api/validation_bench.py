@@ -0,0 +1,64 @@
+"""Validations per second of the request classes.
+
+    python -m scoring_api.validation_bench
+    python -m scoring_api.validation_bench -n 200000
+"""
+import hashlib
+import time
+from optparse import OptionParser
+
+from . import api
+
+SCORE_ARGUMENTS = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "first_name": "Стансилав",
+    "last_name": "Ступников",
+    "birthday": "01.01.1990",
+    "gender": 1,
+}
+METHOD_REQUEST = {
+    "account": "horns&hoofs",
+    "login": "h&f",
+    "method": "online_score",
+    "token": hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest(),
+    "arguments": SCORE_ARGUMENTS,
+}
+
+
+def online_score(arguments):
+    request = api.OnlineScoreRequest(arguments)
+    request.fill_context({'has': list(arguments), 'is_admin': False})
+    request.validate()
+    return request
+
+
+def method(body):
+    request = api.MethodRequest(body)
+    request.validate()
+    return request
+
+
+def run(function, argument, count):
+    started_at = time.perf_counter()
+    for _ in range(count):
+        function(argument)
+    return round(count / (time.perf_counter() - started_at))
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-n", "--count", action="store", type=int, default=50000)
+    (opts, args) = op.parse_args()
+    cases = {
+        'OnlineScoreRequest': (online_score, SCORE_ARGUMENTS),
+        'OnlineScoreRequest, invalid': (online_score, dict(SCORE_ARGUMENTS, phone="89175002040", birthday="1990")),
+        'MethodRequest': (method, METHOD_REQUEST),
+        'MethodRequest, invalid': (method, dict(METHOD_REQUEST, login=None, arguments=[])),
+    }
+    for name, (function, argument) in cases.items():
+        print(f"{name:<30} {run(function, argument, opts.count):>9} validations/s")
+
+
+if __name__ == "__main__":
+    main()
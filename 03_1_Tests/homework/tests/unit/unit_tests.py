@@ -1,7 +1,15 @@
 import unittest
 import functools
+import hashlib
+import http.client
+import json
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from unittest import mock
 
-from scoring_api import api, store
+from scoring_api import api, scoring, store
 
 
 def cases(cases):
@@ -110,6 +118,33 @@ class TestFields(unittest.TestCase):
             field.validate(value)
 
 
+class TestRequestValidation(unittest.TestCase):
+    def test_parsed_values_are_reused(self):
+        request = api.OnlineScoreRequest({"gender": 1, "birthday": "01.01.2000", "first_name": ""})
+        request.fill_context({"has": ["gender", "birthday"], "is_admin": False})
+        self.assertTrue(request.validate())
+        self.assertEqual((request.birthday, request.first_name, request.gender), ("01.01.2000", "", 1))
+        self.assertEqual(request.parsed, {"gender": 1, "birthday": datetime(2000, 1, 1)})
+        self.assertIs(request.birthday_date, request.parsed["birthday"])
+
+    @cases([
+        ("1.1.2000", (datetime(2000, 1, 1), None)),
+        ("31.02.2000", (None, "Wrong date format. DD.MM.YYYY expected")),
+        ("", ("", None)),
+    ])
+    def test_date_check(self, value, result):
+        self.assertEqual(api.DateField().check(value), result)
+
+    def test_errors(self):
+        request = api.MethodRequest({"login": "h&f", "token": "", "arguments": []})
+        request.validate()
+        self.assertEqual(request.errors, [
+            f"{api.ERRORS[api.INVALID_REQUEST]}: Wrong value type. {dict} expected,  got {list}",
+            f"{api.ERRORS[api.INVALID_REQUEST]}: method is not in a query",
+        ])
+        self.assertEqual((request.account, request.login, request.token), ("", "h&f", ""))
+
+
 class TestStorage(unittest.TestCase):
     def setUp(self):
         self.storage = store.DBConnector()
@@ -125,5 +160,550 @@ class TestStorage(unittest.TestCase):
         self.assertEqual(self.storage.get('key_does_not_exist'), None)
 
 
+class SlowInterestsStore:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get(self, key):
+        time.sleep(self.latency)
+        return None
+
+    def get_many(self, keys):
+        time.sleep(self.latency)
+        return {}
+
+
+class MemoryStore:
+    def __init__(self, values=None, cached_values=None):
+        self.values = values or {}
+        self.cached_values = cached_values or {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self.values.get(key)
+
+    def get_many(self, keys):
+        self.calls.append(('get_many', list(keys)))
+        return {key: self.values.get(key) for key in keys}
+
+    def cache_get(self, key):
+        self.calls.append(('cache_get', key))
+        return self.cached_values.get(key)
+
+    def cache_get_many(self, keys, negative=True):
+        self.calls.append(('cache_get_many', list(keys)))
+        return {key: self.cached_values.get(key) for key in keys}
+
+    def cache_set(self, key, value, expire_after=3600):
+        self.calls.append(('cache_set', key))
+        self.cached_values[key] = value
+
+    def cache_get_or_set(self, key, compute, expire_after=3600):
+        self.calls.append(('cache_get_or_set', key))
+        if not self.cached_values.get(key):
+            self.cached_values[key] = compute()
+        return self.cached_values[key]
+
+    def write_back(self, pipelined=None):
+        return nullcontext()
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore({'i:1': '["books"]', 'i:2': '["cars", "pets"]'})
+
+    def make_request(self, method, arguments, login='h&f'):
+        token = hashlib.sha512(('horns&hoofs' + login + api.SALT).encode('utf-8')).hexdigest()
+        return {"account": "horns&hoofs", "login": login, "method": method, "token": token, "arguments": arguments}
+
+    def test_batch(self):
+        score_arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru", "birthday": "01.01.2000",
+                           "gender": 1}
+        body = [
+            self.make_request('clients_interests', {"client_ids": [1, 2, 3]}),
+            dict(self.make_request('clients_interests', {"client_ids": [1]}), token='bad'),
+            self.make_request('online_score', score_arguments),
+            self.make_request('online_score', {"phone": "79175002040"}),
+        ]
+        results, code = api.batch_handler({"body": body, "headers": {}}, {}, self.store)
+        self.assertEqual(code, api.OK)
+        self.assertEqual(results[0], {"response": {1: ["books"], 2: ["cars", "pets"], 3: []}, "code": api.OK})
+        self.assertEqual(results[1], {"error": api.ERRORS[api.FORBIDDEN], "code": api.FORBIDDEN})
+        self.assertEqual(results[2], {"response": {"score": 4.5}, "code": api.OK})
+        self.assertEqual(results[3]["code"], api.INVALID_REQUEST)
+        score_key = scoring.score_key("79175002040", datetime(2000, 1, 1))
+        self.assertEqual(self.store.calls, [
+            ('get_many', ['i:1', 'i:2', 'i:3']),
+            ('cache_get_many', [score_key]),
+            ('cache_set', score_key),
+        ])
+
+    def test_invalid_item_does_not_fail_batch(self):
+        body = [
+            self.make_request('clients_interests', {"client_ids": 5}),
+            self.make_request('clients_interests', {"client_ids": [1]}),
+        ]
+        results, code = api.batch_handler({"body": body, "headers": {}}, {}, self.store)
+        self.assertEqual(code, api.OK)
+        self.assertEqual(results[0]["code"], api.INVALID_REQUEST)
+        self.assertEqual(results[1], {"response": {1: ["books"]}, "code": api.OK})
+
+    def test_invalid_batch(self):
+        for body in ([], {}, [{}] * (api.MAX_BATCH_SIZE + 1)):
+            _, code = api.batch_handler({"body": body, "headers": {}}, {}, self.store)
+            self.assertEqual(code, api.INVALID_REQUEST)
+
+
+class TestBatchMisses(unittest.TestCase):
+    def test_prefetched_misses_are_computed(self):
+        connector = store.DBConnector()
+        collection = connector.mongodb_storage.storage = FakeCollection({})
+        redis = connector.redis_storage.storage = FakeRedis({})
+        token = hashlib.sha512(('horns&hoofs' + 'h&f' + api.SALT).encode('utf-8')).hexdigest()
+        body = [{"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": token,
+                 "arguments": {"phone": f"7917500204{number}", "email": "stupnikov@otus.ru"}}
+                for number in range(5)]
+        results, _ = api.batch_handler({"body": body, "headers": {}}, {}, connector)
+        self.assertEqual(results, [{"response": {"score": 3.0}, "code": api.OK}] * 5)
+        keys = [scoring.score_key(f"7917500204{number}") for number in range(5)]
+        self.assertEqual(redis.calls, [('mget', keys)] + [('set', key) for key in keys])
+        self.assertNotIn(store.NEGATIVE_VALUE, redis.values.values())
+        self.assertEqual(len(collection.queries), 1)
+
+
+class FakeCollection:
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    def find_one(self, query):
+        self.queries.append((query, None))
+        time.sleep(0.05)
+        return {'_id': query['_id'], 'value': self.documents[query['_id']]} if query['_id'] in self.documents else None
+
+    def find(self, query, projection):
+        self.queries.append((query, projection))
+        return [{'_id': key, 'value': self.documents[key]} for key in query['_id']['$in'] if key in self.documents]
+
+
+class FakeRedis:
+    def __init__(self, values, ttls=None):
+        self.values = values
+        self.ttls = ttls or {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return self.values.get(key)
+
+    def mget(self, keys):
+        self.calls.append(('mget', keys))
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, expire_after):
+        self.calls.append(('set', key))
+        self.values[key] = value
+        self.ttls[key] = expire_after
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def get(self, key):
+        self.commands.append(lambda: self.redis.values.get(key))
+
+    def set(self, key, value, expire_after):
+        def command():
+            self.redis.values[key] = value
+            self.redis.ttls[key] = expire_after
+            return True
+        self.commands.append(command)
+
+    def pttl(self, key):
+        self.commands.append(lambda: self.redis.ttls.get(key, -1) * 1000 if key in self.redis.values else -2)
+
+    def execute(self):
+        self.redis.calls.append(('pipeline', len(self.commands)))
+        return [command() for command in self.commands]
+
+
+class TestBulkLookups(unittest.TestCase):
+    def setUp(self):
+        self.store = store.DBConnector()
+        self.collection = self.store.mongodb_storage.storage = FakeCollection(
+            {f'i:{cid}': '["books"]' for cid in range(0, 500, 2)}
+        )
+        self.redis = self.store.redis_storage.storage = FakeRedis({'i:1': '["cars"]'})
+
+    def test_get_many_is_one_query(self):
+        interests = scoring.get_interests_many(self.store, range(500))
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertEqual(self.collection.queries[0][1], {'value': 1})
+        self.assertEqual(interests[0], ['books'])
+        self.assertEqual(interests[1], [])
+
+    def test_cache_get_many(self):
+        keys = [f'i:{cid}' for cid in range(500)]
+        values = self.store.cache_get_many(keys)
+        self.assertEqual(self.redis.calls[0], ('mget', keys))
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertNotIn('i:1', self.collection.queries[0][0]['_id']['$in'])
+        self.assertEqual((values['i:0'], values['i:1'], values['i:3']), ('["books"]', '["cars"]', None))
+
+    def test_clients_interests_request(self):
+        memory_store = MemoryStore({'i:1': '["books"]'})
+        request = api.ClientsInterestsRequest({"client_ids": [1, 2]})
+        request.validate()
+        self.assertEqual(request.response(memory_store), {1: ['books'], 2: []})
+        self.assertEqual(memory_store.calls, [('get_many', ['i:1', 'i:2'])])
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = store.LocalCache(max_entries=3, default_ttl=10, clock=lambda: self.now)
+
+    def test_ttl(self):
+        self.cache.set('a', '1', expire_after=100)
+        self.cache.set('b', '2')
+        self.now = 50
+        self.assertEqual(self.cache.get('a'), '1')
+        self.assertIsNone(self.cache.get('b'))
+        self.now = 100
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats(), {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 2, 'evictions': 0,
+                                              'expirations': 2})
+
+    def test_lru_eviction(self):
+        for key in 'abc':
+            self.cache.set(key, key)
+        self.cache.get('a')
+        self.cache.set('d', 'd')
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual([self.cache.get(key) for key in 'acd'], ['a', 'c', 'd'])
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_byte_budget(self):
+        cache = store.LocalCache(max_bytes=1000)
+        for number in range(100):
+            cache.set(f'key{number}', 'x' * 100)
+        stats = cache.stats()
+        self.assertLessEqual(stats['bytes'], 1000)
+        self.assertEqual(stats['entries'] + stats['evictions'], 100)
+        self.assertEqual(cache.get('key99'), 'x' * 100)
+
+    def test_db_connector_tier(self):
+        connector = store.DBConnector(self.cache)
+        redis = connector.redis_storage.storage = FakeRedis({'uid:1': '3.0', 'uid:2': '1.5'})
+        self.assertEqual(connector.cache_get('uid:1'), '3.0')
+        self.assertEqual(connector.cache_get('uid:1'), '3.0')
+        self.assertEqual(connector.cache_get_many(['uid:1', 'uid:2']), {'uid:1': '3.0', 'uid:2': '1.5'})
+        self.assertEqual(redis.calls, [('get', 'uid:1'), ('mget', ['uid:2'])])
+        connector.cache_set('uid:3', 4.5, 60 * 60)
+        self.assertEqual(connector.cache_get('uid:3'), 4.5)
+        self.assertEqual(connector.stats()['local_cache']['hits'], 3)
+
+
+class TestCoalescing(unittest.TestCase):
+    def run_threads(self, target, count=8):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_single_flight(self):
+        single_flight = store.SingleFlight()
+        calls, results = [], []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'value'
+
+        self.run_threads(lambda: results.append(single_flight.do('key', compute)))
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['value'] * 8)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_single_flight_keeps_recent_results(self):
+        now = [100.0]
+        single_flight = store.SingleFlight(linger=1, clock=lambda: now[0])
+        self.assertEqual(single_flight.do('key', lambda: 'first'), 'first')
+        # a caller that missed before the first call finished gets its result
+        self.assertEqual(single_flight.do('key', lambda: 'second', since=100.0), 'first')
+        now[0] = 100.5
+        self.assertEqual(single_flight.do('key', lambda: 'third', since=100.5), 'third')
+        now[0] = 102.0
+        self.assertEqual(single_flight.do('key', lambda: 'fourth', since=100.0), 'fourth')
+        self.assertEqual(list(single_flight.finished), ['key'])
+
+    def test_single_flight_shares_errors(self):
+        single_flight = store.SingleFlight()
+        errors = []
+
+        def compute():
+            time.sleep(0.05)
+            raise KeyError('key')
+
+        def call():
+            try:
+                single_flight.do('key', compute)
+            except KeyError as e:
+                errors.append(e)
+
+        self.run_threads(call, 4)
+        self.assertEqual(len(errors), 4)
+
+    def test_concurrent_misses_hit_stores_once(self):
+        connector = store.DBConnector()
+        collection = connector.mongodb_storage.storage = FakeCollection({})
+        redis = connector.redis_storage.storage = FakeRedis({})
+        computed, results = [], []
+
+        def compute():
+            computed.append(1)
+            return 4.5
+
+        self.run_threads(lambda: results.append(connector.cache_get_or_set('uid:1', compute, 60)))
+        self.assertEqual(results, [4.5] * 8)
+        self.assertEqual((len(computed), len(collection.queries)), (1, 1))
+        self.assertEqual([call for call in redis.calls if call[0] == 'set'], [('set', 'uid:1')])
+
+    def test_miss_reads_redis_once(self):
+        connector = store.DBConnector()
+        collection = connector.mongodb_storage.storage = FakeCollection({'uid:1': '3.0'})
+        redis = connector.redis_storage.storage = FakeRedis({})
+        self.assertEqual(connector.cache_get_or_set('uid:1', lambda: 4.5, 60), '3.0')
+        self.assertEqual(redis.calls, [('get', 'uid:1'), ('set', 'uid:1')])
+        self.assertEqual(len(collection.queries), 1)
+
+    def test_early_refresh_keeps_mongo_value(self):
+        connector = store.DBConnector(early_refresh_beta=1)
+        connector.mongodb_storage.storage = FakeCollection({'uid:1': '3.0'})
+        redis = connector.redis_storage.storage = FakeRedis({'uid:1': '3.0'}, {'uid:1': 0.001})
+        connector.fill_seconds = 0.01
+        with mock.patch('random.random', return_value=0.999):
+            self.assertEqual(connector.cache_get_or_set('uid:1', lambda: 4.5, 3600), '3.0')
+        self.assertEqual((redis.values['uid:1'], redis.ttls['uid:1']), ('3.0', 3600))
+
+    def test_early_refresh(self):
+        connector = store.DBConnector(early_refresh_beta=1)
+        connector.mongodb_storage.storage = FakeCollection({})
+        redis = connector.redis_storage.storage = FakeRedis({'uid:1': '3.0'}, {'uid:1': 3600})
+        connector.fill_seconds = 0.01
+        self.assertEqual(connector.cache_get_or_set('uid:1', lambda: 4.5, 3600), '3.0')
+        self.assertEqual(redis.calls, [('pipeline', 2)])
+        redis.ttls['uid:1'] = 0.001
+        with mock.patch('random.random', return_value=0.999):
+            self.assertEqual(connector.cache_get_or_set('uid:1', lambda: 4.5, 3600), 4.5)
+        self.assertEqual(redis.values['uid:1'], 4.5)
+
+
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.store = store.DBConnector(store.LocalCache())
+        self.collection = self.store.mongodb_storage.storage = FakeCollection({'i:0': '["books"]'})
+        self.redis = self.store.redis_storage.storage = FakeRedis({})
+
+    def test_missing_key_is_looked_up_once(self):
+        self.assertIsNone(self.store.cache_get('i:1'))
+        self.assertEqual(self.redis.ttls['i:1'], store.NEGATIVE_TTL)
+        self.assertIsNone(self.store.cache_get('i:1'))
+        self.assertEqual((len(self.collection.queries), self.redis.calls), (1, [('get', 'i:1'), ('set', 'i:1')]))
+        self.assertEqual(self.store.stats()['negative_cache'], {'hits': 1, 'sets': 1})
+
+    def test_cache_get_many(self):
+        keys = ['i:0', 'i:1', 'i:2']
+        self.assertEqual(self.store.cache_get_many(keys), {'i:0': '["books"]', 'i:1': None, 'i:2': None})
+        self.assertEqual(self.store.cache_get_many(keys), {'i:0': '["books"]', 'i:1': None, 'i:2': None})
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertEqual(self.store.stats()['negative_cache'], {'hits': 2, 'sets': 2})
+
+    def test_get_many(self):
+        keys = ['i:0', 'i:1', 'i:2']
+        self.assertEqual(self.store.get_many(keys), {'i:0': '["books"]', 'i:1': None, 'i:2': None})
+        self.assertEqual(self.redis.values, {'i:1': store.NEGATIVE_VALUE, 'i:2': store.NEGATIVE_VALUE})
+        self.store.local_cache = None
+        self.assertEqual(self.store.get_many(keys), {'i:0': '["books"]', 'i:1': None, 'i:2': None})
+        self.assertIsNone(self.store.get('i:1'))
+        self.assertEqual(self.collection.queries, [
+            ({'_id': {'$in': keys}}, {'value': 1}),
+            ({'_id': {'$in': ['i:0']}}, {'value': 1}),
+        ])
+        self.assertEqual(self.store.stats()['negative_cache'], {'hits': 3, 'sets': 2})
+
+    def test_clients_interests(self):
+        for _ in range(2):
+            self.assertEqual(scoring.get_interests_many(self.store, [0, 1]), {0: ['books'], 1: []})
+            self.assertEqual(scoring.get_interests(self.store, 2), [])
+        self.assertEqual(len(self.collection.queries), 3)
+
+    def test_cache_get_or_set_skips_mongo(self):
+        self.store.cache_get('uid:1')
+        self.assertEqual(self.store.cache_get_or_set('uid:1', lambda: 4.5, 60), 4.5)
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertEqual(self.store.cache_get('uid:1'), 4.5)
+
+    def test_disabled(self):
+        connector = store.DBConnector(negative_ttl=0)
+        collection = connector.mongodb_storage.storage = FakeCollection({})
+        redis = connector.redis_storage.storage = FakeRedis({})
+        connector.cache_get('i:1')
+        connector.cache_get('i:1')
+        self.assertEqual((len(collection.queries), redis.values), (2, {}))
+
+
+class TestPipelining(unittest.TestCase):
+    def setUp(self):
+        self.collection = FakeCollection({})
+        self.redis = FakeRedis({})
+
+    def make_store(self, pipeline_writes):
+        connector = store.DBConnector(pipeline_writes=pipeline_writes)
+        connector.mongodb_storage.storage = self.collection
+        connector.redis_storage.storage = self.redis
+        return connector
+
+    def test_execute_many(self):
+        redis_storage = store.RedisConnector(store.REDIS_CONFIG, max_connections=4)
+        self.assertEqual(redis_storage.storage.connection_pool.max_connections, 4)
+        redis_storage.storage = self.redis
+        self.assertEqual(redis_storage.execute_many([('set', 'i:1', '[]', 60), ('get', 'i:1')]), [True, '[]'])
+        self.assertEqual(self.redis.calls, [('pipeline', 2)])
+
+    def test_batch_writes_in_one_pipeline(self):
+        token = hashlib.sha512(('horns&hoofs' + 'h&f' + api.SALT).encode('utf-8')).hexdigest()
+        body = [{"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": token,
+                 "arguments": {"phone": f"7917500204{number}", "email": "stupnikov@otus.ru"}}
+                for number in range(3)]
+        results, _ = api.batch_handler({"body": body, "headers": {}}, {}, self.make_store(True))
+        self.assertEqual(results, [{"response": {"score": 3.0}, "code": api.OK}] * 3)
+        self.assertEqual([call[0] for call in self.redis.calls], ['mget', 'pipeline'])
+        self.assertEqual(len(self.collection.queries), 1)
+        self.assertEqual(set(self.redis.values.values()), {3.0})
+
+    def test_writes_are_sent_one_by_one_by_default(self):
+        connector = self.make_store(False)
+        with connector.write_back():
+            connector.cache_set('uid:1', 3.0)
+        self.assertEqual(self.redis.calls, [('set', 'uid:1')])
+
+
+class GatedRedis(FakeRedis):
+    """FakeRedis whose pipelines wait until the gate is opened."""
+
+    def __init__(self, values):
+        super().__init__(values)
+        self.gate = threading.Event()
+
+    def pipeline(self, transaction=True):
+        self.gate.wait(5)
+        return super().pipeline(transaction)
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.redis = GatedRedis({})
+
+    def test_response_does_not_wait_for_redis(self):
+        connector = store.DBConnector(write_behind_size=100)
+        connector.mongodb_storage.storage = FakeCollection({})
+        connector.redis_storage.storage = self.redis
+        self.assertEqual(connector.cache_get_or_set('uid:1', lambda: 4.5, 60), 4.5)
+        self.assertEqual(connector.cache_get('uid:1'), 4.5)
+        self.assertNotIn('uid:1', self.redis.values)
+        self.redis.gate.set()
+        connector.close()
+        self.assertEqual(self.redis.values['uid:1'], 4.5)
+        self.assertEqual(connector.stats()['write_behind']['written'], 1)
+
+    def test_drops_oldest_writes(self):
+        redis_storage = store.RedisConnector(store.REDIS_CONFIG)
+        redis_storage.storage = self.redis
+        queue = store.WriteBehindQueue(redis_storage, max_size=2)
+        queue.put('i:0', '[]', 60)
+        while not queue.sending:
+            time.sleep(0.001)
+        for number in range(1, 4):
+            queue.put(f'i:{number}', '[]', 60)
+        self.assertEqual((list(queue.queue), queue.get('i:0'), queue.get('i:1')), (['i:2', 'i:3'], ('[]', 60), None))
+        self.redis.gate.set()
+        queue.close()
+        self.assertEqual(sorted(self.redis.values), ['i:0', 'i:2', 'i:3'])
+        self.assertEqual(queue.stats(), {'queued': 0, 'written': 3, 'dropped': 1, 'failed': 0, 'batches': 2})
+        with self.assertRaises(RuntimeError):
+            queue.put('i:4', '[]', 60)
+
+    def test_counts_redis_timeouts_as_failed(self):
+        redis_storage = store.RedisConnector(store.REDIS_CONFIG)
+        redis_storage.storage = self.redis
+        self.redis.gate.set()
+        queue = store.WriteBehindQueue(redis_storage)
+        with mock.patch.object(FakePipeline, 'execute', side_effect=store.TimeoutError('timeout')):
+            queue.put('i:0', '[]', 60)
+            queue.close()
+        self.assertEqual((queue.stats()['written'], queue.stats()['failed']), (0, 1))
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        handler_class = type('TestHandler', (api.MainHTTPHandler,), {
+            'store': SlowInterestsStore(0.2),
+            'log_message': lambda self, format, *args: None,
+        })
+        self.server = api.create_server(('localhost', 0), workers=4, backlog=16, handler_class=handler_class)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, connection, request):
+        connection.request('POST', '/method', json.dumps(request))
+        response = connection.getresponse()
+        return response, json.loads(response.read())
+
+    def test_keep_alive(self):
+        token = hashlib.sha512((datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+        request = {"account": "horns&hoofs", "login": "admin", "method": "online_score", "token": token,
+                   "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+        connection = http.client.HTTPConnection('localhost', self.port, timeout=5)
+        _, body = self.post(connection, request)
+        self.assertEqual(body, {"response": {"score": 42}, "code": api.OK})
+        sock = connection.sock
+        response, body = self.post(connection, request)
+        self.assertEqual(response.version, 11)
+        self.assertIs(connection.sock, sock)
+        connection.close()
+
+    def test_slow_store_does_not_block_other_clients(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "token": hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest(),
+                   "arguments": {"client_ids": [1]}}
+        codes = []
+
+        def client():
+            connection = http.client.HTTPConnection('localhost', self.port, timeout=5)
+            codes.append(self.post(connection, request)[1]['code'])
+            connection.close()
+
+        threads = [threading.Thread(target=client) for _ in range(4)]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(codes, [api.OK] * 4)
+        self.assertLess(time.perf_counter() - started_at, 0.6)
+
+
 if __name__ == "__main__":
     unittest.main()